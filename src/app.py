@@ -1,31 +1,117 @@
 '''
  # @ Create Time: 2024-02-15 14:19:06.559386
 '''
-from dash import Dash, html, dcc
+import time
+_started = time.perf_counter()
+
+from dash import Dash, html, dcc, callback, Input, Output, State
 import dash
+import logging
+import os
+
+from core.cache import figure_cache
+from core import data, metrics, responses, workers
+from core.data import get_store
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
 
+# Warn when importing the app takes longer than this
+STARTUP_BUDGET_MS = float(os.environ.get("STARTUP_BUDGET_MS", "3000"))
 
-external_css = ["assets/style.css"]
+startup = {"import": time.perf_counter() - _started}
 
-app = dash.Dash(__name__, use_pages=True, external_stylesheets=external_css, title="PortfolioDash")
+# Page layouts are built on first visit, so their components are missing from the initial layout
+# assets/style.css is included by Dash itself, with its fingerprint
+app = dash.Dash(__name__, use_pages=True, title="PortfolioDash", suppress_callback_exceptions=True)
 server = app.server
+startup["pages"] = time.perf_counter() - _started - sum(startup.values())
+
+# Pages load the lab data on first use; PRELOAD_DATA=1 loads it here instead, before
+# gunicorn forks (--preload), so every worker shares it copy-on-write. The render
+# processes need it loaded before they are forked, so RENDER_WORKERS implies it
+PRELOAD_DATA = os.environ.get("PRELOAD_DATA") == "1" or bool(workers.RENDER_WORKERS)
+if PRELOAD_DATA:
+    get_store().scatter_matrix
+startup["data"] = time.perf_counter() - _started - sum(startup.values())
+
+# Pre-render the single-parameter pages in the background of each worker
+if os.environ.get("FIGURE_CACHE_WARMUP") == "1":
+    server.before_request(figure_cache.start_warmup)
+
+# Pick up new lab extracts without restarting the workers
+if data.RELOAD_INTERVAL:
+    server.before_request(lambda: data.start_reloader())
+
+# Compressed responses and long-lived caching of the assets
+responses.register(app)
+
+if metrics.ENABLED:
+    def cache_stats(keys, suffix=""):
+        stats = figure_cache.stats()
+        return {f"figure_cache_{key}{suffix}": stats[key] for key in keys}
+
+    # Hits and misses only grow, so rate() over them gives the hit rate
+    metrics.register_route(server, gauges=lambda: cache_stats(["entries", "bytes", "max_bytes"]),
+                           counters=lambda: cache_stats(["hits", "misses"], "_total"))
 
 header = html.A(" ", className="navbar-left")
 pages_links = [dcc.Link(page['name'], href=page["relative_path"], className="nav-link fs-5 navbar-right")
                for page in dash.page_registry.values() if page["name"] != "Not found 404"]
 
-app.layout = html.Div([
-    html.Nav(children=[
+
+def layout():
+    # Built on every page load, so study folders added since the start can be picked
+    # Every page shows the study picked here, see find_studies() for how studies are discovered
+    options = data.study_options()
+    study_selector = dcc.Dropdown(id="study", options=options, value=options[0]["value"],
+                                  clearable=False, className="study-select")
+    return html.Div([
+        html.Nav(children=[
+            html.Div([
+                html.Div([header, study_selector] + pages_links, className="navbar")
+            ]),
+        ]),
+        html.Div(style={"height": "10px", "background-color": "#e6e6e6"}),
         html.Div([
-            html.Div([header, ] + pages_links, className="navbar")
+            html.Br(),
+            dash.page_container
         ]),
-    ]),
-    html.Div(style={"height": "10px", "background-color": "#e6e6e6"}),
-    html.Div([
-        html.Br(),
-        dash.page_container
-    ]),
-])
+    ])
+
+
+app.layout = layout
+
+
+def param_dropdown(dropdown, default):
+    '''Fill a parameter dropdown with the parameters of the selected study.'''
+    @callback([Output(dropdown, "options"), Output(dropdown, "value")],
+              Input("study", "value"),
+              State(dropdown, "value"))
+    def update_param_options(study, value):
+        store = get_store(study)
+        if value not in store.params:
+            value = store.params[min(default, len(store.params) - 1)]
+        return store.param_options, value
+
+
+param_dropdown("mydropdown", 0)
+param_dropdown("first_paramcd", 0)
+param_dropdown("second_paramcd", 1)
+
+if PRELOAD_DATA:
+    for page in dash.page_registry.values():
+        if callable(page["layout"]):
+            page["layout"]()
+startup["layout"] = time.perf_counter() - _started - sum(startup.values())
+
+startup_ms = {key: round(value * 1000) for key, value in startup.items()}
+if sum(startup_ms.values()) > STARTUP_BUDGET_MS:
+    logger.warning("Startup took %dms, over the %dms budget: %s", sum(startup_ms.values()), STARTUP_BUDGET_MS, startup_ms)
+else:
+    logger.info("Startup took %dms: %s", sum(startup_ms.values()), startup_ms)
 
 if __name__ == '__main__':
+    if workers.RENDER_WORKERS:
+        workers.start_pool()
     app.run(debug=False)
@@ -0,0 +1,159 @@
+'''
+ Benchmark the four pages on synthetic data.
+
+ For every scale the store load, then data preparation, figure construction
+ and JSON serialization of each page are timed separately, with peak traced
+ memory per page and the peak RSS of the process. Each scale runs in its own
+ interpreter so the process-wide store and RSS start fresh. Run from src/:
+
+   python -m bench.run --rows 10000 100000 1000000 --output bench.json
+   python -m bench.run --rows 10000 100000 --compare bench.json
+'''
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+
+PAGES = ["boxplot", "waterfall", "scatterplot", "seriesplot"]
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def _page_cases(store):
+    from pages import boxplot, scatterplot, seriesplot, waterfall
+
+    params = [param for param in ["SODIUM", "BILI", "ALT", "AST", "GGT"] if param in store.params] or store.params[:5]
+    subject = store.subjects[0]
+    return {
+        "boxplot": (boxplot.box_plot_data, boxplot.create_box_plot, [(param,) for param in params]),
+        "waterfall": (waterfall.waterfall_plot_data, waterfall.create_waterfall_plot, [(param,) for param in params]),
+        "scatterplot": (scatterplot.scatter_plot_data, scatterplot.create_scatter_plot, list(zip(params, params[1:]))),
+        "seriesplot": (seriesplot.series_plot_data, seriesplot.create_series_plot, [(subject,) + pair for pair in zip(params, params[1:])]),
+    }
+
+
+def _bench_page(prepare, create, cases, repeat):
+    from core.figures import to_json
+
+    phases = {"data_ms": [], "figure_ms": [], "serialize_ms": []}
+    size = 0
+    for _ in range(repeat):
+        for args in cases:
+            data, data_ms = _timed(prepare, *args)
+            fig, figure_ms = _timed(create, *args, data)
+            payload, serialize_ms = _timed(to_json, fig)
+            phases["data_ms"].append(data_ms)
+            phases["figure_ms"].append(figure_ms)
+            phases["serialize_ms"].append(serialize_ms)
+            size = max(size, len(payload))
+
+    tracemalloc.start()
+    for args in cases:
+        to_json(create(*args, prepare(*args)))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {phase: round(statistics.median(values), 3) for phase, values in phases.items()}
+    result.update(payload_bytes=size, peak_traced_mb=round(peak / 2 ** 20, 2))
+    return result
+
+
+def run_scale(rows, data_dir, repeat, seed):
+    '''Benchmark one scale in the current process and return the result record.'''
+    from bench import synthetic
+
+    scale_dir = os.path.join(data_dir, str(rows))
+    if not os.path.exists(os.path.join(scale_dir, "adlbc.csv")):
+        synthetic.write(scale_dir, rows, seed=seed)
+    os.environ["DATA_DIR"] = scale_dir
+
+    from core import data
+
+    load = {}
+    for name in ["adlbc.npz", "adsl.npz"]:
+        if os.path.exists(os.path.join(scale_dir, name)):
+            os.remove(os.path.join(scale_dir, name))
+    _, load["csv_ms"] = _timed(data.load_store, scale_dir)
+    store, load["npz_ms"] = _timed(data.get_store)
+    _, load["scatter_matrix_ms"] = _timed(lambda: store.scatter_matrix)
+    load = {key: round(value, 3) for key, value in load.items()}
+
+    import app  # registers the pages, the store is already loaded
+
+    pages = {page: _bench_page(prepare, create, cases, repeat)
+             for page, (prepare, create, cases) in _page_cases(store).items()}
+
+    return {
+        "commit": _commit(),
+        "rows": store.nrows,
+        "subjects": len(store.subjects),
+        "load": load,
+        "pages": pages,
+        "maxrss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def compare(results, baseline):
+    previous = {(record["rows"], page): timings for record in baseline for page, timings in record["pages"].items()}
+    print(f"{'rows':>10} {'page':<12} {'phase':<13} {'before':>10} {'after':>10} {'ratio':>7}")
+    for record in results:
+        for page, timings in record["pages"].items():
+            before = previous.get((record["rows"], page))
+            if before is None:
+                continue
+            for phase in ["data_ms", "figure_ms", "serialize_ms", "payload_bytes"]:
+                ratio = timings[phase] / before[phase] if before[phase] else float("nan")
+                print(f"{record['rows']:>10} {page:<12} {phase:<13} {before[phase]:>10} {timings[phase]:>10} {ratio:>7.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard pages on synthetic data")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--scale-worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scale_worker:
+        print(json.dumps(run_scale(args.rows[0], args.data_dir, args.repeat, args.seed)))
+        return
+
+    results = []
+    for rows in args.rows:
+        cmd = [sys.executable, "-m", "bench.run", "--scale-worker", "--rows", str(rows),
+               "--repeat", str(args.repeat), "--seed", str(args.seed), "--data-dir", args.data_dir]
+        output = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+        record = json.loads(output.strip().splitlines()[-1])
+        results.append(record)
+        print(json.dumps(record), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent=2)
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(results, json.load(fh))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+'''
+ Synthetic CDISC-shaped ADLBC/ADSL extracts for benchmarking.
+
+ Generates the columns the pages read at a requested ADLBC row count:
+
+   python -m bench.synthetic --rows 1000000 --out /tmp/adlbc-1m
+'''
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# paramcd: (typical value, a1lo, a1hi)
+PARAMS = {
+    "SODIUM": (140, 135, 145), "K": (4.2, 3.5, 5.1), "CL": (102, 98, 107), "BILI": (10, 3, 21),
+    "ALT": (20, 6, 34), "AST": (22, 10, 36), "GGT": (25, 8, 61), "ALP": (70, 35, 104),
+    "ALB": (42, 33, 49), "PROT": (70, 60, 80), "CREAT": (80, 53, 115), "BUN": (5, 1.4, 8.6),
+    "URATE": (300, 137, 446), "GLUC": (5.5, 3.9, 6.9), "CA": (2.3, 2.1, 2.6), "PHOS": (1.1, 0.8, 1.5),
+    "CHOL": (5.2, 3.3, 6.2), "CK": (100, 25, 200), "_CK": (100, 25, 200),
+}
+VISITS = np.array([0, 2, 4, 6, 8, 12, 16, 20, 24, 26, 99, np.nan])
+ARMS = np.array(["Placebo", "Xanomeline Low Dose", "Xanomeline High Dose"])
+
+
+def generate(rows, seed=0, study="CDISCPILOT01"):
+    '''Return (adlbc, adsl) frames with roughly ``rows`` ADLBC records.'''
+    rng = np.random.default_rng(seed)
+    params = np.array(list(PARAMS))
+    n_subjects = max(3, int(np.ceil(rows / (len(params) * len(VISITS)))))
+
+    sites = 700 + rng.integers(1, 20, n_subjects)
+    adsl = pd.DataFrame({
+        "studyid": study,
+        "usubjid": [f"01-{site}-{1000 + i}" for i, site in enumerate(sites)],
+        "siteid": sites,
+        "trt01a": ARMS[rng.integers(0, len(ARMS), n_subjects)],
+        "saffl": np.where(rng.random(n_subjects) < 0.98, "Y", "N"),
+    })
+
+    # One row per subject x parameter x visit, cut to the requested size
+    subject = np.repeat(np.arange(n_subjects), len(params) * len(VISITS))[:rows]
+    param = np.tile(np.repeat(np.arange(len(params)), len(VISITS)), n_subjects)[:rows]
+    visit = np.tile(VISITS, n_subjects * len(params))[:rows]
+
+    typical, low, high = (np.array([PARAMS[p][k] for p in params]) for k in range(3))
+    base = typical[param] * rng.lognormal(0, 0.3, len(subject))
+    aval = np.where(visit == 0, base, typical[param] * rng.lognormal(0, 0.5, len(subject)))
+    aval[rng.random(len(subject)) < 0.03] = np.nan
+    ady = np.where(np.isnan(visit), rng.integers(1, 200, len(subject)), np.nan_to_num(visit) * 7 + rng.integers(-2, 3, len(subject)))
+    ady[visit == 0] = -1
+
+    adlbc = pd.DataFrame({
+        "studyid": study,
+        "usubjid": adsl["usubjid"].to_numpy()[subject],
+        "paramcd": params[param],
+        "avisitn": visit,
+        "ady": ady.astype(int),
+        "aval": aval.round(3),
+        "base": base.round(3),
+        "chg": np.where(visit == 0, np.nan, (aval - base).round(3)),
+        "a1hi": high[param],
+        "a1lo": low[param],
+        "trta": adsl["trt01a"].to_numpy()[subject],
+        "saffl": adsl["saffl"].to_numpy()[subject],
+    })
+    return adlbc, adsl
+
+
+def write(out_dir, rows, seed=0):
+    os.makedirs(out_dir, exist_ok=True)
+    adlbc, adsl = generate(rows, seed=seed)
+    adlbc.to_csv(os.path.join(out_dir, "adlbc.csv"), index=False)
+    adsl.to_csv(os.path.join(out_dir, "adsl.csv"), index=False)
+    return adlbc, adsl
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write synthetic adlbc.csv/adsl.csv")
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", required=True)
+    args = parser.parse_args()
+    write(args.out, args.rows, seed=args.seed)
@@ -0,0 +1,87 @@
+'''
+ Pre-rendered figures written by ``python -m prerender``.
+
+ An export directory holds figures/<sha1>.json, named after the hash of the
+ figure JSON so identical figures are stored once, and manifest.json mapping
+ every (page, study, inputs) to its file and the data version it was rendered
+ from. With PRERENDER_DIR set the figure cache serves a figure from there on a
+ miss as long as its data version is still current, and renders it otherwise.
+'''
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+PRERENDER_DIR = os.environ.get("PRERENDER_DIR", "")
+
+
+def entry_key(page, study, inputs):
+    return json.dumps([page, study, list(inputs)])
+
+
+def _write_atomic(path, content, mode="w"):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, mode) as fh:
+        fh.write(content)
+    os.replace(tmp, path)
+
+
+def write_figure(out_dir, payload):
+    '''Store payload under its content hash in out_dir and return the hash.'''
+    digest = hashlib.sha1(payload.encode()).hexdigest()
+    path = os.path.join(out_dir, "figures", f"{digest}.json")
+    if not os.path.exists(path):
+        _write_atomic(path, payload)
+    return digest
+
+
+def write_manifest(out_dir, entries):
+    _write_atomic(os.path.join(out_dir, "manifest.json"), json.dumps({"entries": entries}))
+
+
+def read_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, "manifest.json")) as fh:
+            return json.load(fh)["entries"]
+    except FileNotFoundError:
+        return {}
+
+
+class Artifacts:
+    '''Read side of an export directory; the manifest is re-read when it changes on disk.'''
+
+    def __init__(self, root):
+        self.root = root
+        self._entries = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _manifest(self):
+        try:
+            mtime = os.stat(os.path.join(self.root, "manifest.json")).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        with self._lock:
+            if mtime != self._mtime:
+                self._entries = read_manifest(self.root)
+                self._mtime = mtime
+                logger.info("Loaded %d pre-rendered figures from %s", len(self._entries), self.root)
+            return self._entries
+
+    def lookup(self, page, study, inputs, version):
+        '''Pre-rendered figure JSON of these inputs at this data version, or None.'''
+        entry = self._manifest().get(entry_key(page, study, inputs))
+        if entry is None or entry["version"] != version:
+            return None
+        try:
+            with open(os.path.join(self.root, "figures", f"{entry['file']}.json")) as fh:
+                return fh.read()
+        except OSError:
+            return None
+
+
+artifacts = Artifacts(PRERENDER_DIR) if PRERENDER_DIR else None
@@ -0,0 +1,206 @@
+'''
+ Figure cache shared by the page callbacks.
+
+ Figures are pure functions of the dropdown values and the loaded data, so the
+ serialized figure JSON is kept in a size-bounded LRU keyed by
+ (page, study, inputs, data version). Concurrent requests for a figure that is not
+ cached yet wait for one render instead of each rendering it, which runs in
+ the core.workers pool when RENDER_WORKERS is set, or is read from the
+ PRERENDER_DIR export when that holds the figure at the current data version.
+ Pages that keep the inputs of the figure shown in the browser next to the
+ graph get a dash.Patch of the parts that changed instead of the whole figure.
+'''
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+from dash import Patch
+
+from core import artifacts, data, figures, metrics, workers
+
+
+logger = logging.getLogger(__name__)
+
+
+class FigureCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._warmers = []
+        self._warmup_pid = None
+
+    def get(self, key):
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def put(self, key, payload):
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = payload
+            self._size += len(payload)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def invalidate(self, params, adsl_changed=False, study=None):
+        '''Drop the figures of study whose inputs include one of params, or all its figures when ADSL changed.'''
+        with self._lock:
+            for key in list(self._entries):
+                if key[1] == study and (adsl_changed or any(value in params for value in key[2])):
+                    self._size -= len(self._entries.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+    def render_json(self, page, create, *inputs, study=None):
+        '''Serialized figure for create(*inputs) on the data of study, rendered only on a cache miss.'''
+        with data.pinned_store(study) as store:
+            key = (page, store.study, inputs, store.version_of(*inputs))
+            payload = self.get(key)
+            metrics.observe_cache(payload is not None)
+            if payload is None:
+                payload = self._render(key, create, store)
+        metrics.observe_payload(len(payload))
+        return payload
+
+    def _render(self, key, create, store):
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                return payload
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            with metrics.phase("figure"):
+                return pending.result()
+
+        try:
+            inputs = key[2]
+            payload = artifacts.artifacts.lookup(*key) if artifacts.artifacts else None
+            version = key[3]
+            if payload is None and workers.active():
+                try:
+                    with metrics.phase("figure"):
+                        payload, version = workers.render(create, inputs, store)
+                except BrokenProcessPool:
+                    # The pool is gone for good, this request and its waiters get a figure rendered here
+                    pass
+            if payload is None:
+                with metrics.phase("figure"):
+                    fig = create(*inputs)
+                with metrics.phase("serialize"):
+                    payload = figures.to_json(fig)
+            # A render process that picked up newer data than this request pinned returns a figure for another key
+            if version == key[3]:
+                self.put(key, payload)
+            pending.set_result(payload)
+            return payload
+        except BaseException as exc:
+            pending.set_exception(exc)
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def render(self, page, create, *inputs, study=None):
+        payload = self.render_json(page, create, *inputs, study=study)
+        with metrics.phase("serialize"):
+            return json.loads(payload)
+
+    def render_patch(self, page, create, shown, *inputs, study=None):
+        '''
+        Figure for create(*inputs) and the new shown state. shown is the state
+        returned with the figure in the browser; when that figure is still
+        cached only the parts that differ from it are sent, as a dash.Patch.
+        '''
+        with data.pinned_store(study) as store:
+            payload = self.render_json(page, create, *inputs, study=study)
+            state = {"study": store.study, "inputs": list(inputs), "version": store.version_of(*inputs)}
+            previous = None
+            if shown and shown.get("study") == state["study"] and shown["inputs"] != state["inputs"] \
+                    and shown["version"] == store.version_of(*shown["inputs"]):
+                with self._lock:
+                    previous = self._entries.get((page, store.study, tuple(shown["inputs"]), shown["version"]))
+        with metrics.phase("serialize"):
+            figure = json.loads(payload)
+            previous = json.loads(previous) if previous is not None else None
+            # A different set of traces (e.g. the "choose different values" message) is sent whole
+            if previous is None or len(previous["data"]) != len(figure["data"]):
+                return figure, state
+            patch = Patch()
+            _diff(patch, previous, figure)
+            if metrics.ENABLED:
+                metrics.observe_payload(len(json.dumps(patch.to_plotly_json()["operations"])))
+        return patch, state
+
+    def register_warmup(self, page, create, inputs):
+        '''Pre-render create(*args) for every args in inputs() when warm-up runs.'''
+        self._warmers.append((page, create, inputs))
+
+    def start_warmup(self):
+        # Started per process: threads do not survive gunicorn forking the preloaded app
+        if self._warmup_pid == os.getpid():
+            return
+        self._warmup_pid = os.getpid()
+        threading.Thread(target=self._warmup, name="figure-cache-warmup", daemon=True).start()
+
+    def _warmup(self):
+        for page, create, inputs in self._warmers:
+            for args in inputs():
+                try:
+                    self.render_json(page, create, *args)
+                except Exception:
+                    logger.exception("Warm-up failed for %s%r", page, args)
+        logger.info("Figure cache warm-up finished: %s", self.stats())
+
+
+def _diff(patch, old, new):
+    '''Record on patch the operations that turn old into new, recursing into dicts and equally long lists.'''
+    keys = range(len(new)) if isinstance(new, list) else new
+    for key in keys:
+        if isinstance(new, dict) and key not in old:
+            patch[key] = new[key]
+        elif old[key] != new[key]:
+            if isinstance(new[key], dict) and isinstance(old[key], dict):
+                _diff(patch[key], old[key], new[key])
+            elif isinstance(new[key], list) and isinstance(old[key], list) and len(new[key]) == len(old[key]) \
+                    and all(isinstance(item, (dict, list)) for item in new[key]):
+                _diff(patch[key], old[key], new[key])
+            else:
+                patch[key] = new[key]
+    if isinstance(new, dict):
+        for key in old.keys() - new.keys():
+            del patch[key]
+
+
+figure_cache = FigureCache(max_bytes=int(os.environ.get("FIGURE_CACHE_MB", "64")) * 2 ** 20)
+data.on_reload(figure_cache.invalidate)
@@ -0,0 +1,456 @@
+'''
+ Shared ADLBC/ADSL data store.
+
+ The lab extracts are parsed once per process and kept in a compact columnar
+ form: only the columns the pages read are kept and string columns become
+ categoricals. A binary .npz cache is written next to each CSV so later starts
+ skip CSV parsing. Call get_store() before gunicorn forks (``--preload``) and
+ every worker shares the same pages copy-on-write.
+
+ DATA_DIR may hold one study or one sub-folder per study. Studies are loaded
+ on first use and the least recently used ones are dropped again when the
+ loaded studies exceed STUDY_MEMORY_MB. The budget holds per process: only
+ the studies preloaded before forking are shared, every gunicorn worker and
+ render process loads the other studies it serves itself.
+'''
+import contextlib
+import contextvars
+import functools
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from core import derive, search
+
+
+logger = logging.getLogger(__name__)
+
+RAW_DIR = os.environ.get("DATA_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "raw"))
+
+# Columns the pages read, everything else in the extracts is dropped at load
+ADLBC_COLUMNS = ["studyid", "usubjid", "paramcd", "avisitn", "ady", "aval", "base", "chg", "a1hi", "a1lo", "trta", "saffl"]
+ADSL_COLUMNS = ["studyid", "usubjid", "siteid", "trt01a", "saffl"]
+
+CACHE_FORMAT = 4
+
+# Rows per chunk when streaming ADLBC into the on-disk partitioned store, 0 loads it into memory
+INGEST_CHUNKSIZE = int(os.environ.get("INGEST_CHUNKSIZE", "0"))
+
+# Seconds between checks of the extracts for changes, 0 disables hot reload
+RELOAD_INTERVAL = float(os.environ.get("DATA_RELOAD_INTERVAL", "0"))
+
+# Memory for the studies loaded by one process, the least recently used ones are dropped beyond it (0: no limit)
+STUDY_MEMORY_MB = float(os.environ.get("STUDY_MEMORY_MB", "0"))
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return f"{CACHE_FORMAT}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _to_columnar(df):
+    # Object columns hold one Python str per row; categoricals hold small integer codes
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].astype("category")
+    return df
+
+
+def _save_npz(df, path, stamp):
+    arrays = {"__columns__": np.array(df.columns, dtype=str), "__source__": np.array(stamp)}
+    for i, col in enumerate(df.columns):
+        values = df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            arrays[f"k{i}"] = values.cat.codes.to_numpy()
+            arrays[f"v{i}"] = np.array(values.cat.categories, dtype=str)
+        else:
+            arrays[f"c{i}"] = values.to_numpy()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as fh:
+            np.savez(fh, **arrays)
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        logger.warning("Could not write data cache %s: %s", path, exc)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _load_npz(path, stamp):
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as npz:
+        if str(npz["__source__"]) != stamp:
+            return None
+        columns = {}
+        for i, col in enumerate(npz["__columns__"]):
+            if f"k{i}" in npz:
+                columns[col] = pd.Categorical.from_codes(npz[f"k{i}"], categories=npz[f"v{i}"])
+            else:
+                columns[col] = npz[f"c{i}"]
+    return pd.DataFrame(columns)
+
+
+def read_table(path, columns):
+    '''Read a CSV extract, preferring the binary cache stored next to it.'''
+    stamp = _source_stamp(path)
+    cache_path = os.path.splitext(path)[0] + ".npz"
+    df = _load_npz(cache_path, stamp)
+    if df is None:
+        df = _to_columnar(pd.read_csv(path, usecols=lambda col: col in columns))
+        _save_npz(df, cache_path, stamp)
+    return df
+
+
+def digest(frame):
+    '''Content hash of a frame's rows in order, independent of index and categorical codes.'''
+    return hashlib.sha1(pd.util.hash_pandas_object(frame, index=False).to_numpy().tobytes()).hexdigest()[:12]
+
+
+def memory_of(*objects):
+    '''Bytes held by frames, series and arrays, also inside dicts, lists and tuples of them.'''
+    total = 0
+    for obj in objects:
+        if isinstance(obj, dict):
+            total += memory_of(*obj.values())
+        elif isinstance(obj, (list, tuple)):
+            total += memory_of(*obj)
+        elif isinstance(obj, (pd.DataFrame, pd.Series)):
+            total += int(np.sum(obj.memory_usage(deep=True)))
+        elif obj is not None:
+            total += obj.nbytes
+    return total
+
+
+def subset_masks(adlbc):
+    safety = (adlbc["saffl"] == "Y").to_numpy()
+    avisitn = adlbc["avisitn"].to_numpy()
+    with np.errstate(invalid="ignore"):
+        return {
+            "visit": ~np.isnan(avisitn),
+            "safety": safety & (avisitn >= 0),
+            "post_baseline": safety & (avisitn > 0),
+        }
+
+
+class LabStore:
+    '''
+    ADLBC rows are kept sorted by paramcd so each parameter is one contiguous
+    slice; the row subsets the pages filter on are precomputed per parameter:
+
+      visit          avisitn is not null
+      safety         saffl == "Y" and avisitn >= 0
+      post_baseline  saffl == "Y" and avisitn > 0
+
+    The frame index keeps the original file row numbers, lab() uses it to
+    return rows in file order.
+
+    param_versions holds a content hash per parameter and adsl_version one of
+    ADSL, so a reload can tell which parameters changed.
+    '''
+    SUBSETS = ("visit", "safety", "post_baseline")
+
+    def __init__(self, adlbc, adsl, version):
+        self.adsl = adsl
+        self.version = version
+
+        # Dropdown values in order of first appearance, internal parameters excluded
+        self.params = [value for value in adlbc["paramcd"].unique() if not value.startswith('_')]
+        self.subjects = [value for value in adlbc["usubjid"].unique() if not value.startswith('_')]
+
+        paramcd = adlbc["paramcd"].astype("category")
+        order = np.argsort(paramcd.cat.codes.to_numpy(), kind="stable")
+        self.adlbc = adlbc.take(order)
+
+        codes = paramcd.cat.codes.to_numpy()[order]
+        uniques, starts, counts = np.unique(codes, return_index=True, return_counts=True)
+        self._slices = {paramcd.cat.categories[code]: (start, start + count)
+                        for code, start, count in zip(uniques, starts, counts) if code >= 0}
+
+        masks = subset_masks(self.adlbc)
+        self._subsets = {name: {param: np.flatnonzero(mask[start:stop]) + start
+                                for param, (start, stop) in self._slices.items()}
+                         for name, mask in masks.items()}
+        self._rownum = self.adlbc.index.to_numpy()
+
+        self.param_versions = {param: digest(self.adlbc.iloc[start:stop]) for param, (start, stop) in self._slices.items()}
+        self.adsl_version = digest(adsl)
+        self._box_stats = {}
+        self._aggregates = {}
+
+    @property
+    def nbytes(self):
+        '''Approximate memory held by the store, for the study memory budget.'''
+        # Derived tables count once built, the cached properties are in __dict__ from then on
+        return memory_of(self.adlbc, self.adsl, self._rownum, self._subsets, self._box_stats, self._aggregates,
+                         self.__dict__.get("scatter_matrix"), self.__dict__.get("subject_index"))
+
+    @property
+    def nrows(self):
+        return len(self.adlbc)
+
+    @functools.cached_property
+    def param_options(self):
+        '''Dropdown options of the parameters, shared by every page.'''
+        return [{'label': value, 'value': value} for value in self.params]
+
+    @functools.cached_property
+    def subject_index(self):
+        return search.SubjectIndex(self.subjects, self.adsl)
+
+    def version_of(self, *values):
+        '''Data version of a figure whose inputs are values, changes only when their parameters or ADSL change.'''
+        versions = [self.adsl_version] + [self.param_versions.get(value, "") for value in values if isinstance(value, str)]
+        return hashlib.sha1("|".join(versions).encode()).hexdigest()[:12]
+
+    def inherit(self, previous, changed):
+        '''Reuse the derived tables of previous for the parameters not in changed.'''
+        for paramcd in self._slices:
+            if paramcd in changed:
+                continue
+            if paramcd in previous._box_stats:
+                self._box_stats[paramcd] = previous._box_stats[paramcd]
+            if paramcd in previous._aggregates:
+                self._aggregates[paramcd] = previous._aggregates[paramcd]
+
+    def lab(self, paramcds, subset=None):
+        '''Rows for one or more parameters in file order, optionally restricted to a subset.'''
+        if isinstance(paramcds, str):
+            paramcds = [paramcds]
+        if subset is not None and subset not in self.SUBSETS:
+            raise ValueError(f"Unknown subset {subset!r}, expected one of {self.SUBSETS}")
+
+        parts = []
+        for paramcd in dict.fromkeys(paramcds):
+            if paramcd not in self._slices:
+                continue
+            if subset is None:
+                parts.append(np.arange(*self._slices[paramcd]))
+            else:
+                parts.append(self._subsets[subset][paramcd])
+        if not parts:
+            return self.adlbc.iloc[:0]
+
+        positions = np.concatenate(parts)
+        if len(parts) > 1:
+            positions = positions[np.argsort(self._rownum[positions], kind="stable")]
+        return self.adlbc.iloc[positions]
+
+    def count(self, paramcd, subset):
+        '''Number of rows lab(paramcd, subset) returns, without materializing them.'''
+        return len(self._subsets[subset].get(paramcd, ()))
+
+    def box_stats(self, paramcd):
+        '''Per-visit box statistics of a parameter, see derive.box_stats().'''
+        if paramcd not in self._box_stats:
+            self._box_stats[paramcd] = derive.box_stats(self.lab(paramcd, "visit"))
+        return self._box_stats[paramcd]
+
+    def max_percent_change(self, paramcd):
+        '''Waterfall bars of a parameter, see derive.max_percent_change().'''
+        return derive.max_percent_change(self.lab(paramcd, "post_baseline"))
+
+    def subject_series(self, paramcds, subjid):
+        '''Safety rows of one subject for one or more parameters, in file order.'''
+        rows = self.lab(paramcds, "safety")
+        return rows[rows["usubjid"] == subjid]
+
+    def min_uln(self, paramcd):
+        '''Lowest upper limit of normal (a1hi) of a parameter over the safety rows.'''
+        return self.lab(paramcd, "safety")["a1hi"].min()
+
+    def _scatter_aggregates(self, paramcd):
+        if paramcd not in self._aggregates:
+            rows = self.lab(paramcd, "post_baseline")
+            self._aggregates[paramcd] = (derive.subject_max(rows), derive.reference_limits(rows))
+        return self._aggregates[paramcd]
+
+    @functools.cached_property
+    def scatter_matrix(self):
+        '''Subject x parameter matrix of maximum post-baseline values, built on first use.'''
+        aggregates = [self._scatter_aggregates(paramcd) for paramcd in self._slices]
+        maxima = pd.concat([maxima for maxima, _ in aggregates], ignore_index=True)
+        limits = pd.concat([limits for _, limits in aggregates])
+        return derive.scatter_matrix(maxima, limits, self.adsl)
+
+
+def _sources(raw_dir):
+    return {name: os.path.join(raw_dir, f"{name}.csv") for name in ["adlbc", "adsl"]}
+
+
+def load_store(raw_dir=RAW_DIR, study=None):
+    sources = _sources(raw_dir)
+    stamps = {name: _source_stamp(path) for name, path in sources.items()}
+
+    adsl = read_table(sources["adsl"], ADSL_COLUMNS).rename(columns={'trt01a': 'trta'})
+    version = hashlib.sha1(f"{stamps['adlbc']}|{stamps['adsl']}".encode()).hexdigest()[:12]
+
+    if INGEST_CHUNKSIZE:
+        from core.ingest import load_partitioned
+        store = load_partitioned(sources["adlbc"], adsl, version, stamps["adlbc"], INGEST_CHUNKSIZE)
+    else:
+        store = LabStore(read_table(sources["adlbc"], ADLBC_COLUMNS), adsl, version)
+    store.raw_dir, store.stamps, store.study = raw_dir, stamps, study
+    return store
+
+
+_catalog = None
+_stores = OrderedDict()
+_store_lock = threading.Lock()
+_pinned = contextvars.ContextVar("pinned_store", default=None)
+_reload_listeners = []
+_reloader_pid = None
+
+
+@functools.lru_cache(maxsize=256)
+def _study_id(folder, stamp):
+    try:
+        return str(pd.read_csv(_sources(folder)["adsl"], usecols=["studyid"], nrows=1)["studyid"].iloc[0])
+    except (OSError, ValueError, IndexError):
+        return os.path.basename(folder)
+
+
+def find_studies(raw_dir=RAW_DIR):
+    '''
+    Studies under raw_dir, {study: (folder, label)} in name order. Every
+    sub-folder holding an adlbc.csv and adsl.csv is a study named after the
+    folder; extracts directly in raw_dir form a study named after raw_dir.
+    Studies are labelled with their studyid, and the folder when several
+    folders hold the same study.
+    '''
+    raw_dir = os.path.normpath(raw_dir)
+    folders = [raw_dir] + [os.path.join(raw_dir, name) for name in sorted(os.listdir(raw_dir))]
+    folders = [folder for folder in folders if all(os.path.isfile(path) for path in _sources(folder).values())]
+    ids = {folder: _study_id(folder, _source_stamp(_sources(folder)["adsl"])) for folder in folders}
+    counts = Counter(ids.values())
+    labels = {folder: ids[folder] if counts[ids[folder]] == 1 else f"{ids[folder]} ({os.path.basename(folder)})"
+              for folder in folders}
+    return {os.path.basename(folder): (folder, labels[folder]) for folder in folders}
+
+
+def catalog():
+    '''The studies this process serves, discovered on first use and refreshed by reload_stores().'''
+    global _catalog
+    if _catalog is None:
+        _catalog = find_studies()
+        if not _catalog:
+            raise FileNotFoundError(f"No adlbc.csv and adsl.csv found in {RAW_DIR} or its sub-folders")
+    return _catalog
+
+
+def study_options():
+    '''Options of the study selector, rediscovered on every call so new study folders show up without a restart.'''
+    global _catalog
+    _catalog = find_studies() or catalog()
+    return [{'label': label, 'value': study} for study, (_, label) in _catalog.items()]
+
+
+def _evict():
+    # Least recently used studies go first, the one just used always stays
+    budget = STUDY_MEMORY_MB * 2 ** 20
+    while STUDY_MEMORY_MB and len(_stores) > 1 and sum(store.nbytes for store in _stores.values()) > budget:
+        study, _ = _stores.popitem(last=False)
+        logger.info("Dropped study %s from memory", study)
+
+
+def get_store(study=None):
+    '''Return the store of study (the first study of the catalog by default), loading it on first use.'''
+    pinned = _pinned.get()
+    if pinned is not None and study in (None, pinned.study):
+        return pinned
+    global _catalog
+    studies = catalog()
+    study = study or next(iter(studies))
+    if study not in studies:
+        # Added since the catalog was read
+        _catalog = studies = find_studies() or studies
+    if study not in studies:
+        raise ValueError(f"Unknown study {study!r}, expected one of {list(studies)}")
+    with _store_lock:
+        store = _stores.get(study)
+        if store is None:
+            start = time.perf_counter()
+            store = load_store(studies[study][0], study)
+            _stores[study] = store
+            logger.info("Loaded lab data from %s in %.0fms", store.raw_dir, (time.perf_counter() - start) * 1000)
+        _stores.move_to_end(study)
+        _evict()
+    return store
+
+
+@contextlib.contextmanager
+def pinned_store(study=None):
+    '''Make get_store() return the same snapshot of study for the duration of a request, even across a reload.'''
+    token = _pinned.set(get_store(study))
+    try:
+        yield _pinned.get()
+    finally:
+        _pinned.reset(token)
+
+
+def on_reload(listener):
+    '''Call listener(changed_params, adsl_changed, study) after every reload that swapped in new data.'''
+    _reload_listeners.append(listener)
+
+
+def reload_store(study=None):
+    '''
+    Reload the extracts of study if their files changed and atomically swap in
+    the new store. Derived tables of unchanged parameters are carried over.
+    Returns the set of changed parameters, or None when the files did not change.
+    '''
+    previous = get_store(study)
+    stamps = {name: _source_stamp(path) for name, path in _sources(previous.raw_dir).items()}
+    if stamps == previous.stamps:
+        return None
+
+    store = load_store(previous.raw_dir, previous.study)
+    params = set(previous.param_versions) | set(store.param_versions)
+    changed = {param for param in params if previous.param_versions.get(param) != store.param_versions.get(param)}
+    adsl_changed = previous.adsl_version != store.adsl_version
+    store.inherit(previous, changed)
+
+    with _store_lock:
+        if store.study in _stores:
+            _stores[store.study] = store
+    logger.info("Reloaded lab data of %s, changed parameters: %s, ADSL changed: %s", store.study, sorted(changed), adsl_changed)
+    for listener in _reload_listeners:
+        listener(changed, adsl_changed, store.study)
+    return changed
+
+
+def reload_stores():
+    '''Rediscover the studies and reload every loaded study whose files changed.'''
+    global _catalog
+    _catalog = find_studies() or _catalog
+    with _store_lock:
+        for study in [study for study in _stores if study not in _catalog]:
+            del _stores[study]
+        loaded = list(_stores)
+    for study in loaded:
+        reload_store(study)
+
+
+def start_reloader(interval=RELOAD_INTERVAL):
+    '''Poll the extracts every interval seconds in a background thread of this process.'''
+    global _reloader_pid
+    # Started per process: threads do not survive gunicorn forking the preloaded app
+    if _reloader_pid == os.getpid():
+        return
+    _reloader_pid = os.getpid()
+
+    def poll():
+        while True:
+            time.sleep(interval)
+            try:
+                reload_stores()
+            except Exception:
+                logger.exception("Reloading lab data failed, keeping the current data")
+
+    threading.Thread(target=poll, name="data-reloader", daemon=True).start()
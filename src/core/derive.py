@@ -0,0 +1,131 @@
+'''
+ Derived tables computed from the lab rows with vectorized pandas/NumPy
+ reductions instead of per-subject Python callbacks.
+'''
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+
+ScatterMatrix = namedtuple("ScatterMatrix", ["wide", "limits"])
+
+
+def max_percent_change(rows):
+    '''
+    Maximum percentage change from baseline per subject, for the waterfall page.
+
+    Returns a list of (trta, frame) pairs in treatment order, each frame having
+    usubjid, MaxPchg and xValues_sorted (bar position) columns sorted by
+    descending MaxPchg. A subject is kept
+    when the percentage change of its first row is defined, MaxPchg is capped
+    at 100.
+    '''
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pchg = (100 * (rows["aval"] - rows["base"]) / rows["base"]).to_numpy(dtype=float)
+
+    # Group rows by (trta, usubjid) in sorted key order, keeping file order inside each group
+    group = rows.groupby(["trta", "usubjid"], observed=True, sort=True).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    order = np.argsort(group, kind="stable")
+    order = order[group[order] >= 0]
+    if not len(order):
+        return []
+    starts = np.flatnonzero(np.r_[True, np.diff(group[order]) != 0])
+
+    pchg = pchg[order]
+    subjects = pd.DataFrame({
+        "trta": rows["trta"].to_numpy()[order][starts],
+        "usubjid": rows["usubjid"].to_numpy()[order][starts],
+        "pchg": pchg[starts],
+        "MaxPchg": np.fmax.reduceat(pchg, starts),
+    })
+    subjects = subjects[~subjects["usubjid"].duplicated()].dropna(subset=["pchg"])
+    subjects["MaxPchg"] = np.where(subjects["MaxPchg"] > 100, 100, subjects["MaxPchg"])
+
+    arms = []
+    for trt in subjects["trta"].unique():
+        sorted_data = subjects.loc[subjects["trta"] == trt, ["usubjid", "MaxPchg"]].sort_values(by="MaxPchg", ascending=False)
+        sorted_data["xValues_sorted"] = range(1, len(sorted_data) + 1)
+        arms.append((trt, sorted_data))
+    return arms
+
+
+def reference_limits(rows):
+    '''Lowest a1hi and highest a1lo per paramcd.'''
+    limits = rows.groupby('paramcd', observed=True).agg({'a1hi': 'min', 'a1lo': 'max'})
+    limits.index = limits.index.astype(str)
+    return limits
+
+
+def subject_max(rows):
+    '''Maximum aval per (paramcd, trta, usubjid); applying it to its own output is a no-op.'''
+    maxima = rows.dropna(subset=['aval']).groupby(['paramcd', 'trta', 'usubjid'], observed=True).agg({'aval': 'max'}).reset_index()
+    maxima['paramcd'] = maxima['paramcd'].astype(str)
+    return maxima
+
+
+def scatter_matrix(maxima, limits, adsl):
+    '''
+    Maximum post-baseline value of every parameter per subject, for the scatter page.
+
+    Takes the subject_max() and reference_limits() of the post-baseline rows.
+    wide is indexed by (usubjid, trta, N_trt) with one column per paramcd,
+    limits is indexed by paramcd with the lowest a1hi and highest a1lo.
+    '''
+    # Number of subjects in each treatment group
+    N_Subjs = adsl.groupby('trta', observed=True).size().reset_index(name='Count')
+
+    MaxRslts2 = pd.merge(maxima, N_Subjs, on="trta", how='left')
+    MaxRslts2['N_trt'] = MaxRslts2['trta'].astype(str) + "(N=" + MaxRslts2['Count'].astype(str) + ")"
+    wide = MaxRslts2.pivot(index=["usubjid", "trta", "N_trt"], columns='paramcd', values='aval')
+
+    return ScatterMatrix(wide, limits)
+
+
+def box_stats(rows):
+    '''
+    Box statistics of aval per (avisitn, trta), computed the way plotly.js does
+    for box traces: linear quartiles interpolated at p * n - 0.5 and whiskers
+    at the furthest points within 1.5 IQR of the box. Returns (stats, outliers),
+    outliers in long form. The arm column of stats numbers the arms in the
+    order the box plot draws them from the rows.
+    '''
+    # First appearance in the rows sorted by visit, with the same sort as pages/boxplot.py
+    arms = pd.Index(rows.sort_values(by='avisitn')['trta'].dropna().unique().astype(str))
+    rows = rows.dropna(subset=['aval', 'avisitn'])
+    keys = rows[['avisitn', 'trta']].astype({'trta': str})
+    group = keys.groupby(['avisitn', 'trta'], sort=True).ngroup().to_numpy()
+    values = rows['aval'].to_numpy(dtype=float)
+    order = np.lexsort((values, group))
+    values, group = values[order], group[order]
+
+    stats = keys.iloc[order].drop_duplicates().reset_index(drop=True)
+    if not len(values):
+        columns = ['q1', 'median', 'q3', 'mean', 'n', 'arm', 'lowerfence', 'upperfence']
+        return stats.reindex(columns=list(stats.columns) + columns), keys.assign(aval=values)
+    starts = np.flatnonzero(np.r_[True, np.diff(group) != 0])
+    counts = np.diff(np.r_[starts, len(values)])
+
+    def quantile(p):
+        position = np.clip(p * counts - 0.5, 0, counts - 1)
+        low = np.floor(position).astype(int)
+        frac = position - low
+        return values[starts + low] * (1 - frac) + values[starts + np.ceil(position).astype(int)] * frac
+
+    stats['q1'], stats['median'], stats['q3'] = quantile(0.25), quantile(0.5), quantile(0.75)
+    stats['mean'] = np.add.reduceat(values, starts) / counts
+    stats['n'] = counts
+    stats['arm'] = arms.get_indexer(stats['trta'])
+
+    iqr = (stats['q3'] - stats['q1']).to_numpy()
+    low_bound = (stats['q1'].to_numpy() - 1.5 * iqr)[group]
+    high_bound = (stats['q3'].to_numpy() + 1.5 * iqr)[group]
+    inside = (values >= low_bound) & (values <= high_bound)
+
+    # Sorted values, so the first/last point inside the bounds of each group are the fences
+    within = np.where(inside, values, np.nan)
+    stats['lowerfence'] = np.minimum(stats['q1'], np.fmin.reduceat(within, starts))
+    stats['upperfence'] = np.maximum(stats['q3'], np.fmax.reduceat(within, starts))
+
+    outliers = keys.iloc[order][~inside].assign(aval=values[~inside]).reset_index(drop=True)
+    return stats, outliers
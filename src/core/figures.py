@@ -0,0 +1,51 @@
+'''
+ Plain-dict figure assembly for the page callbacks.
+
+ Building a figure through plotly.graph_objects validates every property as
+ it is set, which costs more than the data work on most pages. The pages
+ build their figures as plain dicts instead: everything that does not depend
+ on the inputs (templates, axis styling, legends, subplot grids) is built once
+ and shared by every figure, only the traces and labels are filled in per
+ request. The dicts serialize to the same JSON the graph_objects code did.
+
+ Shared parts must not be modified by the pages.
+'''
+import functools
+import json
+
+import numpy as np
+import plotly.io as pio
+from plotly.utils import PlotlyJSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+@functools.lru_cache(maxsize=None)
+def template(name):
+    '''Plotly layout template as a dict.'''
+    return pio.templates[name].to_plotly_json()
+
+
+def array(values):
+    '''Column values in a form to_json writes directly: numeric arrays as they are, anything else as a list.'''
+    values = np.asarray(values)
+    return values if values.dtype.kind in "biuf" else values.tolist()
+
+
+def _default(obj):
+    # orjson only writes C-contiguous numeric arrays itself
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def to_json(fig):
+    '''Serialize a figure dict, or a graph_objects figure, to the JSON dcc.Graph expects.'''
+    if not isinstance(fig, dict):
+        return pio.to_json(fig, validate=False)
+    if orjson is not None:
+        return orjson.dumps(fig, default=_default, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(fig, cls=PlotlyJSONEncoder)
@@ -0,0 +1,380 @@
+'''
+ Out-of-core ingestion for lab extracts larger than memory.
+
+ adlbc.csv is streamed in chunks into a directory store next to it
+ (adlbc.store/v-<version>/): one folder of .npz parts per parameter, plus the
+ aggregates the pages need (reference limits, per-subject maxima, per-visit
+ box statistics, waterfall bars) and the safety rows of each parameter sorted
+ by subject, which the series page memory-maps one subject at a time.
+ Ingestion memory grows with subjects x parameters rather than with the row
+ count, and PartitionedStore loads only the partitions of the parameters the
+ box plot shows; the other pages read only aggregates or one subject's rows.
+
+ Every version of the CSV gets its own directory, so a store keeps reading
+ the snapshot it was opened on after a reload. Only one process ingests a
+ version at a time (adlbc.store/ingest.lock), and superseded versions are
+ removed by a later load once no process has a store open on them.
+'''
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking on Windows, where the app runs in a single process
+    fcntl = None
+
+import numpy as np
+import pandas as pd
+
+from core import derive
+from core.data import ADLBC_COLUMNS, LabStore, digest, memory_of, subset_masks
+
+
+logger = logging.getLogger(__name__)
+
+STRING_COLUMNS = ["studyid", "usubjid", "paramcd", "trta", "saffl"]
+PARTITION_CACHE = int(os.environ.get("PARTITION_CACHE", "8"))
+
+# Combine the per-chunk aggregates once this many have accumulated
+COMPACT_EVERY = 16
+
+
+class _Dictionary:
+    '''Append-only string -> code mapping shared by every chunk.'''
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def encode(self, values):
+        for value in values.dropna().unique():
+            if value not in self.codes:
+                self.codes[value] = len(self.values)
+                self.values.append(value)
+        return values.map(self.codes).fillna(-1).to_numpy(dtype=np.int32)
+
+    def categories(self):
+        # Sorted like the categoricals of the in-memory store; remap[-1] keeps missing values at -1
+        values = np.array(self.values, dtype=str)
+        order = np.argsort(values, kind="stable")
+        remap = np.empty(len(values) + 1, dtype=np.int32)
+        remap[order] = np.arange(len(values))
+        remap[-1] = -1
+        return values[order], remap
+
+
+def _compact(maxima, limits):
+    maxima = [derive.subject_max(pd.concat(maxima, ignore_index=True))] if maxima else []
+    if limits:
+        limits = pd.concat(limits)
+        limits = [limits.groupby(level=0).agg({'a1hi': 'min', 'a1lo': 'max'})]
+    return maxima, limits
+
+
+def ingest(adlbc_path, out_dir, chunksize, stamp):
+    '''Stream adlbc_path into a partitioned store at out_dir.'''
+    tmp_dir = f"{out_dir}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    dictionaries = {col: _Dictionary() for col in STRING_COLUMNS}
+    names = []
+    partitions = {}
+    hashers = {}
+    counts = {}
+    maxima, limits = [], []
+    offset = 0
+    reader = pd.read_csv(adlbc_path, usecols=lambda col: col in ADLBC_COLUMNS, chunksize=chunksize,
+                         dtype={col: str for col in STRING_COLUMNS})
+    for n, chunk in enumerate(reader):
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        offset += len(chunk)
+
+        masks = subset_masks(chunk)
+        post_baseline = chunk[masks["post_baseline"]]
+        maxima.append(derive.subject_max(post_baseline))
+        limits.append(derive.reference_limits(post_baseline))
+        if len(maxima) >= COMPACT_EVERY:
+            maxima, limits = _compact(maxima, limits)
+
+        # Row hashes per parameter in file order, numbers as floats so chunk dtypes do not matter
+        hashed = pd.util.hash_pandas_object(chunk.astype({col: float for col in chunk.columns if col not in STRING_COLUMNS}),
+                                            index=False).to_numpy()
+        columns = {col: dictionaries[col].encode(chunk[col]) if col in dictionaries else chunk[col].to_numpy()
+                   for col in chunk.columns}
+        columns["row"] = chunk.index.to_numpy()
+        names = list(columns)
+        param_codes = columns["paramcd"]
+        for code in np.unique(param_codes[param_codes >= 0]):
+            paramcd = dictionaries["paramcd"].values[code]
+            folder = partitions.setdefault(paramcd, f"p{len(partitions)}")
+            os.makedirs(os.path.join(tmp_dir, folder), exist_ok=True)
+            in_param = param_codes == code
+            hashers.setdefault(paramcd, hashlib.sha1()).update(hashed[in_param].tobytes())
+            param_counts = counts.setdefault(paramcd, dict.fromkeys(masks, 0))
+            for subset, mask in masks.items():
+                param_counts[subset] += int(np.count_nonzero(mask[in_param]))
+            np.savez(os.path.join(tmp_dir, folder, f"part-{n:06d}.npz"),
+                     **{col: values[in_param] for col, values in columns.items()})
+        logger.debug("Ingested %d rows of %s", offset, adlbc_path)
+
+    maxima, limits = _compact(maxima, limits)
+    categories = {}
+    for col, dictionary in dictionaries.items():
+        values, remap = dictionary.categories()
+        categories[f"{col}:values"], categories[f"{col}:remap"] = values, remap
+    np.savez(os.path.join(tmp_dir, "categories.npz"), **categories)
+    if maxima:
+        _save_table(maxima[0], os.path.join(tmp_dir, "maxima.npz"))
+        _save_table(limits[0].reset_index(), os.path.join(tmp_dir, "limits.npz"))
+
+    manifest = {
+        "source": stamp,
+        "rows": offset,
+        "partitions": partitions,
+        "versions": {paramcd: hasher.hexdigest()[:12] for paramcd, hasher in hashers.items()},
+        "counts": counts,
+        "params": dictionaries["paramcd"].values,
+        "subjects": dictionaries["usubjid"].values,
+        "columns": names,
+    }
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as fh:
+        json.dump(manifest, fh)
+
+    # One parameter at a time, so this holds at most one partition
+    store = PartitionedStore(tmp_dir, adsl=None, version=None)
+    min_uln = {}
+    for paramcd, folder in partitions.items():
+        stats, outliers = derive.box_stats(store.lab(paramcd, "visit"))
+        _save_table(stats, os.path.join(tmp_dir, folder, "box_stats.npz"))
+        _save_table(outliers, os.path.join(tmp_dir, folder, "box_outliers.npz"))
+        arms = derive.max_percent_change(store.lab(paramcd, "post_baseline"))
+        waterfall = pd.concat([frame.assign(trta=trt) for trt, frame in arms]) if arms else pd.DataFrame(
+            columns=["usubjid", "MaxPchg", "xValues_sorted", "trta"])
+        _save_table(waterfall, os.path.join(tmp_dir, folder, "waterfall.npz"))
+        _write_series(store, paramcd, os.path.join(tmp_dir, folder))
+        min_uln[paramcd] = float(store.lab(paramcd, "safety")["a1hi"].min())
+        store._partitions.clear()
+
+    manifest["min_uln"] = min_uln
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as fh:
+        json.dump(manifest, fh)
+    os.replace(tmp_dir, out_dir)
+
+
+def _save_table(frame, path):
+    # Floats are kept bit for bit, which a CSV round trip does not; strings as codes into their values
+    arrays = {"columns": np.array(frame.columns, dtype=str)}
+    for i, col in enumerate(frame.columns):
+        if frame[col].dtype == object or isinstance(frame[col].dtype, pd.CategoricalDtype):
+            codes, values = pd.factorize(frame[col])
+            arrays[f"k{i}"], arrays[f"v{i}"] = codes, np.array(values, dtype=str)
+        else:
+            arrays[f"c{i}"] = frame[col].to_numpy()
+    np.savez(path, **arrays)
+
+
+def _load_table(path):
+    with np.load(path, allow_pickle=False) as npz:
+        columns = {}
+        for i, col in enumerate(npz["columns"]):
+            if f"k{i}" in npz:
+                columns[col] = pd.Categorical.from_codes(npz[f"k{i}"], categories=npz[f"v{i}"]).astype(object)
+            else:
+                columns[col] = npz[f"c{i}"]
+    return pd.DataFrame(columns)
+
+
+def _read_columns(folder):
+    parts = []
+    for name in sorted(os.listdir(folder)):
+        if name.startswith("part-"):
+            with np.load(os.path.join(folder, name), allow_pickle=False) as npz:
+                parts.append({col: npz[col] for col in npz.files})
+    return {col: np.concatenate([part[col] for part in parts]) for col in parts[0]}
+
+
+def _write_series(store, paramcd, folder):
+    # Safety rows sorted by subject (in file order within one) and the offset of every subject in them,
+    # taken from the partition already loaded, with the categorical codes into the sorted values
+    rows, masks = store._partition(paramcd)
+    rows = rows[masks["safety"]]
+    columns = {col: rows[col].cat.codes.to_numpy() if isinstance(rows[col].dtype, pd.CategoricalDtype) else rows[col].to_numpy()
+               for col in rows.columns}
+    columns["row"] = rows.index.to_numpy()
+    subjects = columns["usubjid"]
+    order = np.argsort(subjects, kind="stable")
+    os.makedirs(os.path.join(folder, "series"))
+    for col, values_ in columns.items():
+        np.save(os.path.join(folder, "series", f"{col}.npy"), values_[order])
+    np.save(os.path.join(folder, "series", "offsets.npy"),
+            np.searchsorted(subjects[order], np.arange(len(store._categories["usubjid"][0]) + 1)))
+
+
+class PartitionedStore(LabStore):
+    '''
+    LabStore backed by an ingested directory store. Same query API; the rows of
+    a parameter are read from disk on first use and the most recently used
+    PARTITION_CACHE parameters are kept in memory.
+    '''
+
+    def __init__(self, store_dir, adsl, version):
+        self.store_dir = store_dir
+        self.adsl = adsl
+        self.version = version
+        # Held open with a shared lock while the store lives, so _prune() leaves the directory alone
+        self._manifest_file = open(os.path.join(store_dir, "manifest.json"))
+        if fcntl is not None:
+            fcntl.flock(self._manifest_file, fcntl.LOCK_SH)
+        self.manifest = json.load(self._manifest_file)
+        self.params = [value for value in self.manifest["params"] if not value.startswith('_')]
+        self.subjects = [value for value in self.manifest["subjects"] if not value.startswith('_')]
+        self._slices = self.manifest["partitions"]
+        self.param_versions = self.manifest["versions"]
+        self.adsl_version = digest(adsl) if adsl is not None else None
+        with np.load(os.path.join(store_dir, "categories.npz"), allow_pickle=False) as npz:
+            self._categories = {col: (npz[f"{col}:values"], npz[f"{col}:remap"]) for col in STRING_COLUMNS}
+        self._partitions = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            partitions = list(self._partitions.values())
+        return memory_of(partitions, self.adsl, self.__dict__.get("scatter_matrix"), self.__dict__.get("subject_index"))
+
+    def count(self, paramcd, subset):
+        return self.manifest["counts"].get(paramcd, {}).get(subset, 0)
+
+    def inherit(self, previous, changed):
+        # Derived tables live in the store directory and are rebuilt by ingest()
+        pass
+
+    @property
+    def nrows(self):
+        return self.manifest["rows"]
+
+    def _frame(self, columns, remapped=False):
+        for col, (values, remap) in self._categories.items():
+            if col in columns:
+                codes = columns[col] if remapped else remap[columns[col]]
+                columns[col] = pd.Categorical.from_codes(codes, categories=values)
+        index = columns.pop("row")
+        return pd.DataFrame(columns, index=index)
+
+    def _read_partition(self, paramcd):
+        rows = self._frame(_read_columns(os.path.join(self.store_dir, self._slices[paramcd])))
+        return rows, subset_masks(rows)
+
+    def _partition(self, paramcd):
+        with self._lock:
+            if paramcd in self._partitions:
+                self._partitions.move_to_end(paramcd)
+                return self._partitions[paramcd]
+        partition = self._read_partition(paramcd)
+        with self._lock:
+            self._partitions[paramcd] = partition
+            while len(self._partitions) > PARTITION_CACHE:
+                self._partitions.popitem(last=False)
+        return partition
+
+    def lab(self, paramcds, subset=None):
+        if isinstance(paramcds, str):
+            paramcds = [paramcds]
+        if subset is not None and subset not in self.SUBSETS:
+            raise ValueError(f"Unknown subset {subset!r}, expected one of {self.SUBSETS}")
+
+        frames = []
+        for paramcd in dict.fromkeys(paramcds):
+            if paramcd in self._slices:
+                rows, masks = self._partition(paramcd)
+                frames.append(rows if subset is None else rows[masks[subset]])
+        if not frames:
+            return self._partition(next(iter(self._slices)))[0].iloc[:0]
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames).sort_index(kind="stable")
+
+    @functools.cached_property
+    def scatter_matrix(self):
+        maxima = _load_table(os.path.join(self.store_dir, "maxima.npz"))
+        limits = _load_table(os.path.join(self.store_dir, "limits.npz")).set_index("paramcd")
+        return derive.scatter_matrix(maxima, limits, self.adsl)
+
+    def box_stats(self, paramcd):
+        folder = os.path.join(self.store_dir, self._slices[paramcd])
+        return _load_table(os.path.join(folder, "box_stats.npz")), _load_table(os.path.join(folder, "box_outliers.npz"))
+
+    def max_percent_change(self, paramcd):
+        if paramcd not in self._slices:
+            return []
+        bars = _load_table(os.path.join(self.store_dir, self._slices[paramcd], "waterfall.npz"))
+        return [(trt, bars.loc[bars["trta"] == trt, ["usubjid", "MaxPchg", "xValues_sorted"]]) for trt in bars["trta"].unique()]
+
+    def subject_series(self, paramcds, subjid):
+        if isinstance(paramcds, str):
+            paramcds = [paramcds]
+        values, _ = self._categories["usubjid"]
+        code = int(np.searchsorted(values, subjid))
+        known = code < len(values) and values[code] == subjid
+        frames = []
+        for paramcd in dict.fromkeys(paramcds):
+            if paramcd not in self._slices:
+                continue
+            folder = os.path.join(self.store_dir, self._slices[paramcd], "series")
+            offsets = np.load(os.path.join(folder, "offsets.npy"))
+            start, stop = (offsets[code], offsets[code + 1]) if known else (0, 0)
+            # Memory-mapped, only the rows of this subject are read
+            frames.append(self._frame({col: np.array(np.load(os.path.join(folder, f"{col}.npy"), mmap_mode="r")[start:stop])
+                                       for col in self.manifest["columns"]}, remapped=True))
+        if not frames:
+            return self.lab(paramcds, "safety")
+        return pd.concat(frames).sort_index(kind="stable") if len(frames) > 1 else frames[0]
+
+    def min_uln(self, paramcd):
+        return self.manifest["min_uln"].get(paramcd, np.nan)
+
+
+def _prune(root, current):
+    # Called with the ingest lock held: leftovers of failed ingests and versions no store has open
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not name.startswith("v-") or path == current:
+            continue
+        if name.endswith(".tmp"):
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        try:
+            with open(os.path.join(path, "manifest.json")) as fh:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                shutil.rmtree(path, ignore_errors=True)
+        except BlockingIOError:
+            pass
+        except FileNotFoundError:
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            logger.info("Removed superseded store %s", path)
+
+
+def load_partitioned(adlbc_path, adsl, version, stamp, chunksize):
+    '''Open the directory store of this version of adlbc_path, ingesting it if no process did yet.'''
+    root = os.path.splitext(adlbc_path)[0] + ".store"
+    store_dir = os.path.join(root, "v-" + hashlib.sha1(stamp.encode()).hexdigest()[:12])
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, "ingest.lock"), "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(os.path.join(store_dir, "manifest.json")):
+            logger.info("Ingesting %s in chunks of %d rows", adlbc_path, chunksize)
+            ingest(adlbc_path, store_dir, chunksize, stamp)
+        store = PartitionedStore(store_dir, adsl, version)
+        if fcntl is not None:
+            _prune(root, store_dir)
+    return store
@@ -0,0 +1,156 @@
+'''
+ Opt-in callback instrumentation (METRICS_ENABLED=1).
+
+ instrument() wraps a page callback and records its latency per phase
+ (data, figure, serialize and total), the size of the figure JSON and whether
+ the figure cache answered it. register_route() exposes the numbers in the
+ Prometheus text format on /metrics. Each gunicorn worker keeps its own
+ counters, like the figure cache. Callbacks slower than SLOW_CALLBACK_MS are
+ logged with their inputs.
+'''
+import contextlib
+import functools
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response
+
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get("METRICS_ENABLED") == "1"
+SLOW_CALLBACK_MS = float(os.environ.get("SLOW_CALLBACK_MS", "1000"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1e3, 1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound:g}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f'{name}_sum{{{labels}}} {self.sum:.6f}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+_lock = threading.Lock()
+_latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+_payload = defaultdict(lambda: Histogram(SIZE_BUCKETS))
+_cache = defaultdict(int)
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def phase(name):
+    '''Time a block of the current callback. Nested phases are excluded from the enclosing one.'''
+    record = getattr(_local, "record", None)
+    if record is None:
+        yield
+        return
+    stack = record["stack"]
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = stack.pop()
+        record["phases"][name] = record["phases"].get(name, 0.0) + elapsed - nested
+        if stack:
+            stack[-1] += elapsed
+
+
+def observe_payload(size):
+    record = getattr(_local, "record", None)
+    if record is not None:
+        record["payload"] = size
+
+
+def observe_cache(hit):
+    record = getattr(_local, "record", None)
+    if record is not None:
+        record["cache"] = "hit" if hit else "miss"
+
+
+def instrument(func):
+    '''Record the phases of every call of a callback; returns func unchanged when metrics are disabled.'''
+    if not ENABLED:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _local.record = record = {"stack": [], "phases": {}, "payload": None, "cache": None}
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            total = time.perf_counter() - start
+            _local.record = None
+            name = func.__name__
+            with _lock:
+                _latency[(name, "total")].observe(total)
+                for phase_name, seconds in record["phases"].items():
+                    _latency[(name, phase_name)].observe(seconds)
+                if record["payload"] is not None:
+                    _payload[name].observe(record["payload"])
+                if record["cache"] is not None:
+                    _cache[(name, record["cache"])] += 1
+            if total * 1000 > SLOW_CALLBACK_MS:
+                phases = ", ".join(f"{key}={value * 1000:.1f}ms" for key, value in record["phases"].items())
+                logger.warning("Slow callback %s%r: %.1fms (%s, payload=%s bytes, cache=%s)",
+                               name, args, total * 1000, phases, record["payload"], record["cache"])
+
+    return wrapper
+
+
+def render_text(gauges=None, counters=None):
+    lines = [
+        "# HELP dash_callback_seconds Page callback latency per phase.",
+        "# TYPE dash_callback_seconds histogram",
+    ]
+    with _lock:
+        for (name, phase_name), histogram in sorted(_latency.items()):
+            lines.extend(histogram.lines("dash_callback_seconds", f'callback="{name}",phase="{phase_name}"'))
+        lines += ["# HELP dash_callback_payload_bytes Size of the figure JSON returned by a callback.",
+                  "# TYPE dash_callback_payload_bytes histogram"]
+        for name, histogram in sorted(_payload.items()):
+            lines.extend(histogram.lines("dash_callback_payload_bytes", f'callback="{name}"'))
+        lines += ["# HELP dash_callback_cache_total Figure cache lookups per callback.",
+                  "# TYPE dash_callback_cache_total counter"]
+        for (name, result), count in sorted(_cache.items()):
+            lines.append(f'dash_callback_cache_total{{callback="{name}",result="{result}"}} {count}')
+    for name, value in (gauges() if gauges else {}).items():
+        lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    for name, value in (counters() if counters else {}).items():
+        lines += [f"# TYPE {name} counter", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+def register_route(server, gauges=None, counters=None):
+    '''
+    Serve the metrics on /metrics of the Flask server; gauges() and counters()
+    return extra name -> value pairs, counter names end in _total.
+    '''
+    @server.route("/metrics")
+    def metrics():
+        return Response(render_text(gauges, counters), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,88 @@
+'''
+ Compression and HTTP caching for the Flask server.
+
+ - Text and JSON responses above COMPRESS_MIN_BYTES are sent brotli (when the
+   brotli package is installed) or gzip compressed to browsers that accept it.
+   The figure JSON of the callbacks shrinks several-fold; the static Dash
+   bundles are compressed once and kept compressed.
+ - Files of assets/ requested with their modification time (?m=..., added by
+   Dash for the stylesheets and by asset_url() for the images) are cached by
+   browsers for good, a changed file gets a new URL.
+'''
+import functools
+import gzip
+import os
+
+import dash
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+
+COMPRESSIBLE = ("text/", "application/json", "application/javascript", "image/svg+xml")
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def _compress(body, encoding, static):
+    if encoding == "br":
+        return brotli.compress(body, quality=9 if static else 4)
+    return gzip.compress(body, compresslevel=9 if static else 6)
+
+
+@functools.lru_cache(maxsize=64)
+def _compress_static(body, encoding):
+    return _compress(body, encoding, True)
+
+
+def _encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+def asset_url(path):
+    '''URL of a file in assets/ with its modification time, so browsers can cache it for good.'''
+    mtime = os.path.getmtime(os.path.join(dash.get_app().config.assets_folder, path))
+    return f"{dash.get_asset_url(path)}?m={mtime}"
+
+
+def register(app):
+    '''Add compression and asset caching to the server of the Dash app.'''
+    server = app.server
+    assets_path = f"{app.config.routes_pathname_prefix}{app.config.assets_url_path.strip('/')}/"
+    static_paths = (assets_path, f"{app.config.routes_pathname_prefix}_dash-component-suites/")
+
+    @server.after_request
+    def cache_and_compress(response):
+        if response.status_code != 200:
+            return response
+        if request.path.startswith(assets_path) and "m" in request.args:
+            response.headers["Cache-Control"] = IMMUTABLE
+
+        # Files are sent as a passthrough stream, generated responses are left alone
+        if ((response.is_streamed and not response.direct_passthrough) or "Content-Encoding" in response.headers
+                or not response.mimetype.startswith(COMPRESSIBLE)):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = _encoding()
+        if encoding is None:
+            return response
+        response.direct_passthrough = False
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_BYTES:
+            return response
+        # The Dash bundles and assets are the same on every request, worth compressing harder once
+        if request.path.startswith(static_paths):
+            response.set_data(_compress_static(body, encoding))
+        else:
+            response.set_data(_compress(body, encoding, False))
+        response.headers["Content-Encoding"] = encoding
+        return response
@@ -0,0 +1,50 @@
+'''
+ Subject search for the Series Plot dropdown.
+
+ Subject IDs are kept in one sorted array of lower-cased keys, so the subjects
+ starting with a typed prefix are a contiguous range found with two binary
+ searches. Each subject is indexed under its full ID and under the number after
+ the site ("1015" finds 01-701-1015). Site and arm come from ADSL.
+'''
+import numpy as np
+import pandas as pd
+
+
+class SubjectIndex:
+    def __init__(self, subjects, adsl):
+        self.subjects = np.array(subjects, dtype=str)
+        info = adsl.drop_duplicates("usubjid").set_index("usubjid") if adsl is not None else pd.DataFrame(columns=["siteid", "trta"])
+        info.index = info.index.astype(str)
+        self.sites = info["siteid"].astype(str).reindex(self.subjects).fillna("").to_numpy()
+        self.arms = info["trta"].astype(str).reindex(self.subjects).fillna("").to_numpy()
+
+        ids = np.char.lower(self.subjects)
+        keys = np.concatenate([ids, np.char.rpartition(ids, "-")[:, 2]])
+        positions = np.tile(np.arange(len(ids)), 2)
+        order = np.argsort(keys, kind="stable")
+        self._keys = keys[order]
+        self._positions = positions[order]
+
+    @property
+    def nbytes(self):
+        return self.subjects.nbytes + self.sites.nbytes + self.arms.nbytes + self._keys.nbytes + self._positions.nbytes
+
+    @property
+    def site_options(self):
+        return [{'label': value, 'value': value} for value in sorted(set(self.sites) - {""})]
+
+    @property
+    def arm_options(self):
+        return [{'label': value, 'value': value} for value in sorted(set(self.arms) - {""})]
+
+    def search(self, query, site=None, arm=None, limit=50):
+        '''First limit subject IDs matching the query prefix, in order of first appearance in ADLBC.'''
+        query = (query or "").strip().lower()
+        start = np.searchsorted(self._keys, query, side="left")
+        stop = np.searchsorted(self._keys, query + chr(0x10FFFF), side="left")
+        positions = np.unique(self._positions[start:stop])
+        if site:
+            positions = positions[self.sites[positions] == str(site)]
+        if arm:
+            positions = positions[self.arms[positions] == arm]
+        return self.subjects[positions[:limit]].tolist()
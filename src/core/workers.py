@@ -0,0 +1,71 @@
+'''
+ Optional process pool for figure rendering (RENDER_WORKERS=N).
+
+ Building a figure is pandas and Python work that holds the GIL, so with
+ threaded gunicorn workers one slow page would still stall the others. With
+ RENDER_WORKERS set, figure cache misses are rendered in a pool of N forked
+ processes. The pool is forked by the post_fork hook of gunicorn.conf.py,
+ before the gunicorn worker starts any thread that could hold a lock in the
+ forked processes, and after the app and its data were preloaded in the
+ master, so the processes share the data copy-on-write. A process without a
+ pool, or whose pool broke, renders in the request thread.
+'''
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from core import data, figures
+
+
+logger = logging.getLogger(__name__)
+
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "0"))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _render(create, inputs, study, version):
+    store = data.get_store(study)
+    if store.version != version:
+        # The app reloaded the extracts after this process was forked
+        data.reload_store(study)
+    with data.pinned_store(study) as store:
+        return figures.to_json(create(*inputs)), store.version_of(*inputs)
+
+
+def start_pool():
+    '''Fork the render processes of this process, call it before any other thread starts.'''
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(RENDER_WORKERS, mp_context=multiprocessing.get_context("fork"))
+            # The fork context starts every process on the first task, so start them now
+            _pool.submit(os.getpid).result()
+            _pool_pid = os.getpid()
+            logger.info("Started %d render processes", RENDER_WORKERS)
+
+
+def active():
+    '''Whether this process has a working pool, see start_pool().'''
+    return _pool_pid == os.getpid()
+
+
+def render(create, inputs, store):
+    '''
+    Serialized figure for create(*inputs), rendered in the pool, and the data
+    version it was rendered from.
+    '''
+    global _pool_pid
+    try:
+        return _pool.submit(_render, create, inputs, store.study, store.version).result()
+    except BrokenProcessPool:
+        # A render process died; forking a new pool from a threaded worker is not safe, the figure
+        # cache renders this request and the following ones in the request threads
+        logger.error("Render processes died, rendering in the request threads from now on")
+        _pool_pid = None
+        raise
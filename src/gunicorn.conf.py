@@ -0,0 +1,20 @@
+'''
+ gunicorn settings, run from the repository root:
+
+   gunicorn -c src/gunicorn.conf.py --chdir src app:server
+'''
+
+# Threaded workers keep serving cached figures while the render processes build new ones
+worker_class = "gthread"
+threads = 8
+
+# Load the app and its data in the master so the workers and their render processes share it
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Before the worker starts its threads, which the forked render processes must not inherit mid-lock
+    from core import workers
+
+    if workers.RENDER_WORKERS:
+        workers.start_pool()
@@ -1,66 +1,129 @@
-import pandas as pd
-import numpy as np
-import plotly.express as px
 import dash
 from dash import  dcc, html, Input, Output, callback
+import os
 import warnings
 
+from core import figures
+from core.cache import figure_cache
+from core.data import get_store
+from core.metrics import instrument, phase
+from core.responses import asset_url
+
 # Ignore all future warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 dash.register_page(__name__, path='/boxplot', name="Box Plot")
 
-adlbc_raw = pd.read_csv("raw/adlbc.csv")
+# Parameters with more values than this are drawn from server-side box statistics
+BOX_SUMMARY_ROWS = int(os.environ.get("BOX_SUMMARY_ROWS", "20000"))
+
+def box_plot_data(trt_selection):
+    store = get_store()
+    if store.count(trt_selection, "visit") > BOX_SUMMARY_ROWS:
+        return store.box_stats(trt_selection)
+    adlbc_filtred = store.lab(trt_selection, "visit")
+    return adlbc_filtred[["aval","avisitn","trta"]].sort_values(by="avisitn").astype({"avisitn":"str"})
+
+LEGEND = {"font": {"size": 12, "color": "black"}, "orientation": "h", "title": {"text": ""}, "x": 0.3, "y": -0.1,
+          "bordercolor": "black", "borderwidth": 1}
+TITLE_FONT = {"size": 24, "family": "Balto"}
+# Arm colours, as plotly express assigns them
+COLORWAY = figures.template("plotly")["layout"]["colorway"]
+
+def _hovertemplate(trt_selection):
+    return f'<b>{trt_selection}/b>: %{{y}}<br>' + '<b>Visit Number</b>: %{x}'
+
+def point_box_traces(adlbc_plot, hovertemplate):
+    # One box per arm drawn from every value, arms in order of appearance
+    traces = []
+    for i, trt in enumerate(adlbc_plot["trta"].unique()):
+        arm = adlbc_plot[adlbc_plot["trta"] == trt]
+        traces.append({"alignmentgroup": "True", "hovertemplate": hovertemplate, "legendgroup": trt,
+                       "marker": {"color": COLORWAY[i % len(COLORWAY)]}, "name": trt, "notched": False, "offsetgroup": trt,
+                       "orientation": "v", "showlegend": True, "x": arm["avisitn"].tolist(), "x0": " ", "xaxis": "x",
+                       "y": figures.array(arm["aval"]), "y0": " ", "yaxis": "y", "type": "box"})
+    return traces
+
+def summary_box_arms(stats):
+    # In the order, and so with the colours, point_box_traces() gives them
+    return stats.drop_duplicates("trta").sort_values("arm")["trta"]
 
-def create_box_plot(trt_selection):
-    adlbc_filtred = adlbc_raw[(adlbc_raw["paramcd"] == trt_selection) & (adlbc_raw["avisitn"].notnull())]          
-    adlbc_plot = adlbc_filtred[["aval","avisitn","trta"]].sort_values(by="avisitn").astype({"avisitn":"str"})
+def summary_box_traces(stats, outliers, hovertemplate):
+    # One box per visit and arm from precomputed quartiles, only the outliers are sent as points
+    traces = []
+    for i, trt in enumerate(summary_box_arms(stats)):
+        arm = stats[stats["trta"] == trt]
+        points = outliers[outliers["trta"] == trt].groupby("avisitn")["aval"].apply(list)
+        traces.append({"alignmentgroup": "True", "boxpoints": "outliers", "legendgroup": trt,
+                       "lowerfence": figures.array(arm["lowerfence"]), "marker": {"color": COLORWAY[i % len(COLORWAY)]},
+                       "mean": figures.array(arm["mean"]),
+                       "median": figures.array(arm["median"]), "name": trt, "offsetgroup": trt, "orientation": "v",
+                       "q1": figures.array(arm["q1"]), "q3": figures.array(arm["q3"]), "upperfence": figures.array(arm["upperfence"]),
+                       "x": arm["avisitn"].astype(str).tolist(), "y": [points.get(visit, []) for visit in arm["avisitn"]],
+                       "type": "box", "hovertemplate": hovertemplate})
+    return traces
 
-    fig = px.box(adlbc_plot, x = "avisitn", y = "aval", color = "trta")
+def create_box_plot(trt_selection, adlbc_plot=None):
+    if adlbc_plot is None:
+        with phase("data"):
+            adlbc_plot = box_plot_data(trt_selection)
 
-    fig.update_layout(xaxis_title = "Visit", yaxis_title = f"Analysis value: {trt_selection.title()}", template = "simple_white",
-                      legend = dict(orientation = "h", 
-                                    title = "", x = 0.3, y = -0.1,
-                                    font = dict(size = 12, color = "black"), bordercolor = "black", borderwidth = 1), 
-                      title_text="<b>Test Results for {} in Each Visit<b>".format(trt_selection.title()), title_x=0.5, title_font=dict(size=24, family="Balto"))
-    
-    fig.update_traces(hovertemplate= f'<b>{trt_selection}/b>: %{{y}}<br>' +
-                                     '<b>Visit Number</b>: %{x}')
-    
-    return fig
+    layout = {
+        "template": figures.template("simple_white"),
+        "legend": LEGEND,
+        "boxmode": "group",
+        "title": {"font": TITLE_FONT, "text": "<b>Test Results for {} in Each Visit<b>".format(trt_selection.title()), "x": 0.5},
+        "xaxis": {"title": {"text": "Visit"}},
+        "yaxis": {"title": {"text": f"Analysis value: {trt_selection.title()}"}},
+    }
+    if isinstance(adlbc_plot, tuple):
+        return {"data": summary_box_traces(*adlbc_plot, _hovertemplate(trt_selection)), "layout": layout}
 
-layout = html.Div(children=[
-    html.Div([
+    layout["xaxis"].update(anchor="y", domain=[0.0, 1.0])
+    layout["yaxis"].update(anchor="x", domain=[0.0, 1.0])
+    layout["legend"] = dict(LEGEND, tracegroupgap=0)
+    layout["margin"] = {"t": 60}
+    return {"data": point_box_traces(adlbc_plot, _hovertemplate(trt_selection)), "layout": layout}
+
+def layout(**kwargs):
+    # No study data here: the options are filled in for the selected study, see param_dropdown in app.py
+    return html.Div(children=[
         html.Div([
-            html.Header("Parameter Category:", style={'color': "#17c6d3"}),
-            dcc.Dropdown(
-                id="mydropdown", 
-                options=[{'label': value, 'value': value} for value in adlbc_raw["paramcd"].unique() if not value.startswith('_')],
-                value="SODIUM",
-                style={'margin-top': "15px"}
-            ),
             html.Div([
-                html.Footer("Follow me:", style={'color': "#17c6d3", 'display': 'inline-block', 'vertical-align': 'middle'}),
-                html.A(
-                    html.Img(src="assets/linked.png", className="linked-img"),
-                    href="https://www.linkedin.com/in/noy-simonyan-888683266/",
-                    style={'display': 'inline-block'}
+                html.Header("Parameter Category:", style={'color': "#17c6d3"}),
+                dcc.Dropdown(
+                    id="mydropdown", 
+                    options=[],
+                    value="SODIUM",
+                    style={'margin-top': "15px"}
                 ),
-                html.A(
-                    html.Img(src="assets/git.png", className="git-img"),
-                    href="https://github.com/iReaperz",
-                    style={'display': 'inline-block'}
-                )
-            ], className="plotWB"),
-        ], className="dropDownBW"),
-        html.Div([
-            dcc.Graph(id="boxPlot", className="graph-class")
-        ], className = "graph-div")
-    ], className="main-div"),
-], className="container")
+                html.Div([
+                    html.Footer("Follow me:", style={'color': "#17c6d3", 'display': 'inline-block', 'vertical-align': 'middle'}),
+                    html.A(
+                        html.Img(src=asset_url("linked.png"), className="linked-img"),
+                        href="https://www.linkedin.com/in/noy-simonyan-888683266/",
+                        style={'display': 'inline-block'}
+                    ),
+                    html.A(
+                        html.Img(src=asset_url("git.png"), className="git-img"),
+                        href="https://github.com/iReaperz",
+                        style={'display': 'inline-block'}
+                    )
+                ], className="plotWB"),
+            ], className="dropDownBW"),
+            html.Div([
+                dcc.Graph(id="boxPlot", className="graph-class")
+            ], className = "graph-div")
+        ], className="main-div"),
+    ], className="container")
 
 
 @callback(Output("boxPlot", "figure"),
-              Input("mydropdown", "value"))
-def update_box_plot(trt_selection):
-    return create_box_plot(trt_selection)
\ No newline at end of file
+              [Input("mydropdown", "value"),
+               Input("study", "value")])
+@instrument
+def update_box_plot(trt_selection, study):
+    return figure_cache.render("boxplot", create_box_plot, trt_selection, study=study)
+
+
+figure_cache.register_warmup("boxplot", create_box_plot, lambda: [(value,) for value in get_store().params])
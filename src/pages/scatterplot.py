@@ -1,57 +1,107 @@
 import pandas as pd
 import plotly.express as px
-import plotly.graph_objects as go
 import dash
-from dash import  dcc, html, Input, Output, callback
+from dash import  dcc, html, Input, Output, State, callback
+import functools
+import json
+import os
+
+from core import figures
+from core.cache import figure_cache
+from core.data import get_store
+from core.metrics import instrument, phase
+from core.responses import asset_url
 
 dash.register_page(__name__, path='/scatterplot', name="Scatter Plot")
 
-#Importing data
-adlbc_raw = pd.read_csv("raw/adlbc.csv")
-adsl_raw = pd.read_csv("raw/adsl.csv")
-adsl_raw.rename(columns={'trt01a': 'trta'}, inplace=True)
+# Facets are drawn with WebGL (Scattergl) above this many subjects
+SCATTER_GL_POINTS = int(os.environ.get("SCATTER_GL_POINTS", "1000"))
+# Optional cap on plotted subjects, subjects above a reference limit are always kept (0 disables)
+SCATTER_MAX_POINTS = int(os.environ.get("SCATTER_MAX_POINTS", "0"))
 
-layout = html.Div(children=[
-    html.Div([
+def layout(**kwargs):
+    # No study data here: the options are filled in for the selected study, see param_dropdown in app.py
+    return html.Div(children=[
         html.Div([
-            html.Header("Parameter Category 1:", style={'color': "#17c6d3"}),
-            dcc.Dropdown(
-                id="first_paramcd",
-                options=[{'label': value, 'value': value} for value in adlbc_raw["paramcd"].unique() if not value.startswith('_')],
-                value="BILI",
-                style={'margin-top': "5px"}
-            ),
-            html.Header("Parameter Category 2:", style={'margin-top': "20px", 'color': "#17c6d3"}),
-            dcc.Dropdown(
-                id="second_paramcd",
-                options=[{'label': value, 'value': value} for value in adlbc_raw["paramcd"].unique() if not value.startswith('_')],
-                value="ALT",
-                style={'margin-top': "5px"}
-            ),
             html.Div([
-                html.Footer("Follow me:", style={'color': "#17c6d3", 'display': 'inline-block', 'vertical-align': 'middle'}),
-                html.A(
-                    html.Img(src="assets/linked.png", className="linked-img"),
-                    href="https://www.linkedin.com/in/noy-simonyan-888683266/",
-                    style={'display': 'inline-block'}
+                html.Header("Parameter Category 1:", style={'color': "#17c6d3"}),
+                dcc.Dropdown(
+                    id="first_paramcd",
+                    options=[],
+                    value="BILI",
+                    style={'margin-top': "5px"}
                 ),
-                html.A(
-                    html.Img(src="assets/git.png", className="git-img"),
-                    href="https://github.com/iReaperz",
-                    style={'display': 'inline-block'}
-                )
-            ], className="plotSC"),
-        ], className="dropDownSC"),
-        html.Div([
-            dcc.Graph(id="scatterplot", className="graph-class")
-        ], className = "graph-div")
-    ], className="main-div"),
-], className="container")
+                html.Header("Parameter Category 2:", style={'margin-top': "20px", 'color': "#17c6d3"}),
+                dcc.Dropdown(
+                    id="second_paramcd",
+                    options=[],
+                    value="ALT",
+                    style={'margin-top': "5px"}
+                ),
+                html.Div([
+                    html.Footer("Follow me:", style={'color': "#17c6d3", 'display': 'inline-block', 'vertical-align': 'middle'}),
+                    html.A(
+                        html.Img(src=asset_url("linked.png"), className="linked-img"),
+                        href="https://www.linkedin.com/in/noy-simonyan-888683266/",
+                        style={'display': 'inline-block'}
+                    ),
+                    html.A(
+                        html.Img(src=asset_url("git.png"), className="git-img"),
+                        href="https://github.com/iReaperz",
+                        style={'display': 'inline-block'}
+                    )
+                ], className="plotSC"),
+            ], className="dropDownSC"),
+            html.Div([
+                dcc.Graph(id="scatterplot", className="graph-class"),
+                # Inputs of the figure in the browser, lets the callback send only what changed
+                dcc.Store(id="scatterplot-shown")
+            ], className = "graph-div")
+        ], className="main-div"),
+    ], className="container")
+
+
+
+
+def scatter_plot_data(first_val, second_val):
+    # Maximum post baseline results and reference lines are precomputed for every parameter
+    matrix = get_store().scatter_matrix
+    pair = sorted([first_val, second_val])
+
+    highs_lows = matrix.limits.loc[pair]
+    transposed = matrix.wide[pair].dropna(how="all")
+
+    if SCATTER_MAX_POINTS and len(transposed) > SCATTER_MAX_POINTS:
+        abnormal = (transposed > highs_lows['a1hi'].values).any(axis=1)
+        sampled = transposed[~abnormal].sample(n=max(SCATTER_MAX_POINTS - int(abnormal.sum()), 0), random_state=0)
+        transposed = pd.concat([transposed[abnormal], sampled]).sort_index()
+
+    return transposed, highs_lows['a1hi'].values, highs_lows['a1lo'].values
+
 
+AXIS_STYLE = dict(title_text='', ticks='inside', linecolor='black', type="log", mirror=True)
+REF_LINE = {"color": "gray", "dash": "dash", "width": 2}
+TITLE_FONT = {"size": 24, "family": "Balto"}
+COLORWAY = figures.template("plotly")["layout"]["colorway"]
+FOOTNOTES = [
+    {"showarrow": False, "text": "Each data point represents a unique subject.", "x": 0, "xref": "paper", "y": -0.07, "yref": "paper"},
+    {"showarrow": False, "text": "Logarithmic scaling was used on both X and Y axis.", "x": 0, "xref": "paper", "y": -0.09, "yref": "paper"},
+]
 
 
+@functools.lru_cache(maxsize=None)
+def _facet_grid(n_facets):
+    '''Axes and facet titles of a figure with n_facets columns, laid out once by plotly express.'''
+    fig = px.scatter(x=[1] * n_facets, y=[1] * n_facets, facet_col=[str(i) for i in range(n_facets)], facet_col_spacing=0.001)
+    fig.update_xaxes(**AXIS_STYLE)
+    fig.update_yaxes(**AXIS_STYLE)
+    layout = json.loads(figures.to_json(fig))["layout"]
+    # The empty font plotly express gives the facet titles is dropped once more annotations are added
+    titles = [{key: value for key, value in anno.items() if key != "font"} for anno in layout["annotations"]]
+    return {key: value for key, value in layout.items() if key.startswith(("xaxis", "yaxis"))}, titles
 
-def create_scatter_plot(first_val, second_val):
+
+def create_scatter_plot(first_val, second_val, data=None):
     if first_val == second_val:
         return {
             'data': [],
@@ -62,58 +112,60 @@ def create_scatter_plot(first_val, second_val):
             }
         }
 
-    # Filtering data
-    adlbc = adlbc_raw[(adlbc_raw['avisitn'] > 0) & (adlbc_raw['saffl'] == 'Y') & (adlbc_raw['paramcd'].isin([first_val, second_val]))]
-    # Calculating number of subjects in each treatment group
-    N_Subjs = adsl_raw.groupby('trta').size().reset_index(name='Count')
-
-    # Calculating reference lines
-    highs_lows = adlbc.sort_values('paramcd').groupby('paramcd').agg({'a1hi': 'min', 'a1lo': 'max'}).reset_index()
-    RefLineH1, RefLineH2 = highs_lows['a1hi'].values
-    RefLineL1, RefLineL2 = highs_lows['a1lo'].values
-
-    # Calculating maximum results
-    MaxRslts1 = adlbc.dropna(subset=['aval']).groupby(['paramcd', 'trta', 'usubjid'],).agg({'aval': 'max'}).reset_index()
-    # Merging with the number of subjects
-    MaxRslts2 = pd.merge(MaxRslts1, N_Subjs, on = "trta", how='left')
-    MaxRslts2['N_trt'] = MaxRslts2['trta'] + "(N=" + MaxRslts2['Count'].astype(str) + ")"
-    transposed = MaxRslts2.pivot(index=["usubjid","trta","N_trt"], columns='paramcd', values='aval')
+    if data is None:
+        with phase("data"):
+            data = scatter_plot_data(first_val, second_val)
+    transposed, (RefLineH1, RefLineH2), (RefLineL1, RefLineL2) = data
     n_levels = transposed.index.get_level_values('N_trt')
-
-    fig = px.scatter(transposed, x=second_val, y=first_val, facet_col=n_levels, color=n_levels, 
-                 facet_col_spacing = 0.001)
-
-    fig.add_hline(y=RefLineH2,line_width=2, line_dash="dash", line_color="gray")
-    fig.add_hline(y=RefLineL2,line_width=2, line_dash="dash", line_color="gray")
-    fig.add_vline(x=RefLineH1,line_width=2, line_dash="dash", line_color="gray")
-    fig.add_vline(x=RefLineL1,line_width=2, line_dash="dash", line_color="gray")
-
-    for i,anno in enumerate(fig['layout']['annotations']):
-        anno['text']=[f"{col_name}" for col_name in n_levels.unique()][i]
-
-    fig.update_traces(mode="markers", 
-                    hovertemplate= '<b>Subject</b>: %{customdata}<br>' +
-                                    f'<b>{second_val}</b>: %{{x}}<br>' +
-                                    f'<b>{first_val}</b>: %{{y}}'+
-                                    '<extra></extra>',
-                    customdata=transposed.index.get_level_values('usubjid').unique())
-
-
-    fig.update_xaxes(title_text='',ticks='inside',linecolor='black',type="log",mirror=True)
-    fig.update_yaxes(title_text='',ticks='inside',linecolor='black',type="log",mirror=True)
-
-    fig.add_annotation(showarrow=False,xref='paper', x=0.5, yref='paper',y=-0.06,text=f'Maximum post baseline {second_val}', font=dict(size=14))
-    fig.add_annotation(showarrow=False,xref='paper', x=-0.06, yref='paper',y=0.5,textangle=-90,text=f'Maximum post baseline {first_val}',font=dict(size=14))
-    fig.add_annotation(showarrow=False,xref='paper', x=0, yref='paper',y=-0.07,text='Each data point represents a unique subject.')
-    fig.add_annotation(showarrow=False,xref='paper', x=0, yref='paper',y=-0.09,text='Logarithmic scaling was used on both X and Y axis.')
-
-    fig.update_layout(plot_bgcolor='white',showlegend=False, title_text=f'<b>Scatter Plot of {first_val} vs {second_val} (Safety Analysis Set)</b>', title_x=0.5, title_font=dict(size=24, family="Balto"))
-
-    return fig
-
-
-@callback(Output("scatterplot", "figure"),
+    levels = n_levels.unique()
+    axes, facet_titles = _facet_grid(len(levels))
+    webgl = len(transposed) > SCATTER_GL_POINTS
+
+    hovertemplate = ('<b>Subject</b>: %{customdata}<br>' + f'<b>{second_val}</b>: %{{x}}<br>' +
+                     f'<b>{first_val}</b>: %{{y}}' + '<extra></extra>')
+    subjects = transposed.index.get_level_values('usubjid').unique().tolist()
+    traces = []
+    for i, level in enumerate(levels):
+        facet = transposed[n_levels == level]
+        suffix = "" if i == 0 else str(i + 1)
+        trace = {"hovertemplate": hovertemplate, "legendgroup": level, "marker": {"color": COLORWAY[i % len(COLORWAY)], "symbol": "circle"},
+                 "mode": "markers", "name": level, "showlegend": True, "x": figures.array(facet[second_val]), "xaxis": "x" + suffix,
+                 "y": figures.array(facet[first_val]), "yaxis": "y" + suffix, "type": "scattergl" if webgl else "scatter",
+                 "customdata": subjects}
+        if not webgl:
+            trace["orientation"] = "v"
+        traces.append(trace)
+
+    # Reference lines are repeated in every facet
+    suffixes = [""] + [str(i + 1) for i in range(1, len(levels))]
+    shapes = [{"line": REF_LINE, "type": "line", "x0": 0, "x1": 1, "xref": f"x{suffix} domain", "y0": y, "y1": y, "yref": f"y{suffix}"}
+              for y in (RefLineH2, RefLineL2) for suffix in suffixes]
+    shapes += [{"line": REF_LINE, "type": "line", "x0": x, "x1": x, "xref": f"x{suffix}", "y0": 0, "y1": 1, "yref": f"y{suffix} domain"}
+               for x in (RefLineH1, RefLineL1) for suffix in suffixes]
+
+    annotations = [dict(title, text=level) for title, level in zip(facet_titles, levels)] + [
+        {"font": {"size": 14}, "showarrow": False, "text": f'Maximum post baseline {second_val}', "x": 0.5, "xref": "paper", "y": -0.06, "yref": "paper"},
+        {"font": {"size": 14}, "showarrow": False, "text": f'Maximum post baseline {first_val}', "textangle": -90, "x": -0.06, "xref": "paper", "y": 0.5, "yref": "paper"},
+    ] + FOOTNOTES
+
+    return {"data": traces, "layout": dict(
+        axes,
+        template=figures.template("plotly"),
+        annotations=annotations,
+        legend={"title": {"text": "color"}, "tracegroupgap": 0},
+        margin={"t": 60},
+        shapes=shapes,
+        title={"font": TITLE_FONT, "text": f'<b>Scatter Plot of {first_val} vs {second_val} (Safety Analysis Set)</b>', "x": 0.5},
+        plot_bgcolor='white',
+        showlegend=False,
+    )}
+
+
+@callback([Output("scatterplot", "figure"), Output("scatterplot-shown", "data")],
               [Input("first_paramcd", "value"),
-               Input("second_paramcd", "value")])
-def update_scatter_plot(first_val, second_val):
-    return create_scatter_plot(first_val, second_val)
+               Input("second_paramcd", "value"),
+               Input("study", "value")],
+              State("scatterplot-shown", "data"))
+@instrument
+def update_scatter_plot(first_val, second_val, study, shown):
+    return figure_cache.render_patch("scatterplot", create_scatter_plot, shown, first_val, second_val, study=study)
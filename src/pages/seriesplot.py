@@ -1,57 +1,107 @@
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 import dash
-from dash import  dcc, html, Input, Output, callback
+import os
+from dash import  dcc, html, Input, Output, State, callback
+
+from core import figures
+from core.cache import figure_cache
+from core.data import get_store
+from core.metrics import instrument, phase
+from core.responses import asset_url
 
 
 dash.register_page(__name__, path='/', name="Series Plot")
 
-raw = pd.read_csv("raw/adlbc.csv")
+# Subjects offered by the subject dropdown for one search
+SUBJECT_SEARCH_LIMIT = int(os.environ.get("SUBJECT_SEARCH_LIMIT", "50"))
 
-layout = html.Div(children=[
-    html.Div([
+def layout(**kwargs):
+    # No study data here: the options are filled in for the selected study, see update_subject_filters
+    # and param_dropdown in app.py
+    return html.Div(children=[
         html.Div([
-            html.Header("Subject ID:", style={'color' : "#17c6d3"}),
-            dcc.Dropdown(
-                id="usubjid",
-                options=[{'label': value, 'value': value} for value in raw["usubjid"].unique() if not value.startswith('_')],
-                value="01-701-1015", style={'margin-top' : "5px"}
-            ),
-            html.Header("Parameter Category 1:", style={'margin-top' : "20px", 'color' : "#17c6d3"}),
-            dcc.Dropdown(
-                id="first_paramcd",
-                options=[{'label': value, 'value': value} for value in raw["paramcd"].unique() if not value.startswith('_')],
-                value="ALT", style={'margin-top' : "5px"}
-            ),
-            html.Header("Parameter Category 2:", style={'margin-top' : "20px", 'color' : "#17c6d3"}),
-            dcc.Dropdown(
-                id="second_paramcd",
-                options=[{'label': value, 'value': value} for value in raw["paramcd"].unique() if not value.startswith('_')],
-                value="AST", style={'margin-top' : "5px"}
-            ), 
             html.Div([
-                html.Footer("Follow me:", style={'color': "#17c6d3", 'display': 'inline-block', 'vertical-align': 'middle'}),
-                html.A(
-                    html.Img(src="assets/linked.png", className="linked-img"),
-                    href="https://www.linkedin.com/in/noy-simonyan-888683266/",
-                    style={'display': 'inline-block'}
+                html.Header("Site:", style={'color' : "#17c6d3"}),
+                dcc.Dropdown(
+                    id="siteid",
+                    options=[],
+                    placeholder="All sites", style={'margin-top' : "5px"}
                 ),
-                html.A(
-                    html.Img(src="assets/git.png", className="git-img"),
-                    href="https://github.com/iReaperz",
-                    style={'display': 'inline-block'}
-                )
-            ], className="plotSE"),
-        ], className = "dropDownSE"),
-        html.Div([
-            dcc.Graph(id="seriesplot", className="graph-class")
-        ], className = "graph-div")
-    ], className="main-div"),
-], className="container")
+                html.Header("Arm:", style={'margin-top' : "20px", 'color' : "#17c6d3"}),
+                dcc.Dropdown(
+                    id="arm",
+                    options=[],
+                    placeholder="All arms", style={'margin-top' : "5px"}
+                ),
+                html.Header("Subject ID:", style={'margin-top' : "20px", 'color' : "#17c6d3"}),
+                # Options are searched on the server, see search_subjects
+                dcc.Dropdown(
+                    id="usubjid",
+                    options=[{'label': "01-701-1015", 'value': "01-701-1015"}],
+                    value="01-701-1015", style={'margin-top' : "5px"}
+                ),
+                html.Header("Parameter Category 1:", style={'margin-top' : "20px", 'color' : "#17c6d3"}),
+                dcc.Dropdown(
+                    id="first_paramcd",
+                    options=[],
+                    value="ALT", style={'margin-top' : "5px"}
+                ),
+                html.Header("Parameter Category 2:", style={'margin-top' : "20px", 'color' : "#17c6d3"}),
+                dcc.Dropdown(
+                    id="second_paramcd",
+                    options=[],
+                    value="AST", style={'margin-top' : "5px"}
+                ), 
+                html.Div([
+                    html.Footer("Follow me:", style={'color': "#17c6d3", 'display': 'inline-block', 'vertical-align': 'middle'}),
+                    html.A(
+                        html.Img(src=asset_url("linked.png"), className="linked-img"),
+                        href="https://www.linkedin.com/in/noy-simonyan-888683266/",
+                        style={'display': 'inline-block'}
+                    ),
+                    html.A(
+                        html.Img(src=asset_url("git.png"), className="git-img"),
+                        href="https://github.com/iReaperz",
+                        style={'display': 'inline-block'}
+                    )
+                ], className="plotSE"),
+            ], className = "dropDownSE"),
+            html.Div([
+                dcc.Graph(id="seriesplot", className="graph-class"),
+                # Inputs of the figure in the browser, lets the callback send only what changed
+                dcc.Store(id="seriesplot-shown")
+            ], className = "graph-div")
+        ], className="main-div"),
+    ], className="container")
+
+
+def series_plot_data(subjid, first_val, second_val):
+    store = get_store()
+    alt_min, ast_min = store.min_uln(first_val), store.min_uln(second_val)
 
+    filtered_raw = store.subject_series([first_val, second_val], subjid)
+    table_data = filtered_raw.groupby(["paramcd", "ady"], observed=True).sum("chg").reset_index().pivot(index="paramcd", columns="ady", values="chg")
+    return filtered_raw, table_data, alt_min, ast_min
 
-def create_series_plot(subjid, first_val, second_val):
+
+LINE_COLORS = ["purple", "darkgreen"]
+LINE_TYPES = ["dash", "longdash"]
+LEGEND = {"font": {"size": 12, "color": "black"}, "orientation": "h", "title": {"text": ""}, "x": 0.5, "y": 0.155,
+          "bordercolor": "black", "borderwidth": 1}
+TITLE_FONT = {"size": 24, "family": "Balto"}
+FOOTNOTES = [
+    {"font": {"size": 14}, "showarrow": False, "text": "Change from Baseline", "x": 0.03, "xref": "paper", "y": 0.1, "yref": "paper"},
+    {"font": {"size": 18}, "showarrow": False, "text": "Analysis value", "textangle": -90, "x": -0.06, "xref": "paper", "y": 0.65, "yref": "paper"},
+    {"font": {"size": 18}, "showarrow": False, "text": "Study day relative to treatment start day", "x": 0.535, "xref": "paper", "y": 0.17, "yref": "paper"},
+]
+CLEAR = {"color": "rgba(0, 0, 0, 0)"}
+
+
+def _uln_line(y):
+    return {"line": {"color": "gray", "dash": "solid", "width": 1}, "opacity": 0.7, "type": "line",
+            "x0": 0, "x1": 1, "xref": "x domain", "y0": y, "y1": y, "yref": "y"}
+
+
+def create_series_plot(subjid, first_val, second_val, data=None):
     if first_val == second_val:
         return {
             'data': [],
@@ -62,79 +112,78 @@ def create_series_plot(subjid, first_val, second_val):
             }
         }
 
-    filtered_raw = raw[(raw["paramcd"].isin([first_val, second_val])) & 
-                       (raw["avisitn"] >= 0) & (raw["saffl"] == "Y")]
-
-    # Preparing data for further analysis
-    uln_values = filtered_raw.groupby("paramcd").agg(minUALN=("a1hi", "min"), maxUALN=("a1hi", "max")).reset_index()
-    alt_min = uln_values.loc[uln_values["paramcd"] == first_val, "minUALN"].values[0]
-    ast_min = uln_values.loc[uln_values["paramcd"] == second_val, "minUALN"].values[0]
+    if data is None:
+        with phase("data"):
+            data = series_plot_data(subjid, first_val, second_val)
+    filtered_raw, table_data, alt_min, ast_min = data
 
-    filtered_raw = filtered_raw[filtered_raw["usubjid"] == subjid]
-    table_data = filtered_raw.groupby(["paramcd", "ady"]).sum("chg").reset_index().pivot(index="paramcd", columns="ady", values="chg")
-    colors = ["purple", "darkgreen"]
-    line_types = ["dash", "longdash"]
-
-    fig = go.Figure()
+    traces = []
     for i, paramcd in enumerate(filtered_raw["paramcd"].unique()):
-        fig.add_trace(go.Scatter(
-            x=filtered_raw["ady"][filtered_raw["paramcd"] == paramcd].astype({"ady":"str"}),
-            y=filtered_raw["aval"][filtered_raw["paramcd"] == paramcd],
-            marker=dict(color=colors[i]),
-            line=dict(dash = line_types[i]),
-            name=paramcd
-        ))
-
-
-    fig.add_hline(y=alt_min,line_width=1, line_dash="solid", line_color="gray", opacity=0.7)
-    fig.add_hline(y=ast_min,line_width=1, line_dash="solid", line_color="gray", opacity=0.7)
-
-    fig.update_layout(height =800, template = "simple_white",
-                        legend = dict(orientation = "h", 
-                                    title = "", x = 0.5, y = 0.155,
-                                    font = dict(size = 12, color = "black"), bordercolor = "black", borderwidth = 1), 
-                        title_text=f"<b>{first_val} and {second_val} Results Over Time. (Safety Analysis Set)</b>", title_x=0.535,
-                        title_font=dict(size=24, family="Balto"))
-
-    fig.add_trace(go.Table(
-        header=dict(values=[], fill=dict(color='rgba(0, 0, 0, 0)')),
-        cells=dict(
-            values=[table_data[param].round(3) for param in table_data.columns],
-            fill=dict(color='rgba(0, 0, 0, 0)')
-        ),
-        domain=dict(y=[0, 0.1])  # Adjust the y values as needed
-    ))
-
-    # Adjust the yaxis domain to leave space for the table
-    fig.update_layout(
-        yaxis=dict(domain=[0.25, 1])  # Adjust the values as needed
-    )
-
-        
-    fig.update_layout(
-        xaxis=dict(
-            tickmode='array',
-            tickvals=[str(val) for val in filtered_raw["ady"][filtered_raw["paramcd"] == paramcd].unique()]
-        )
-    )
-
-
-    fig.add_annotation(x=1, y=alt_min + 0.21,text=f'{first_val} ULN',showarrow=False,font=dict(size=8),xref="paper")
-    fig.add_annotation(x=1,y=ast_min + 0.21, text=f'{second_val} ULN', showarrow=False, font=dict(size=8), xref="paper")
-    fig.add_annotation(showarrow=False,xref='paper', x=0, yref='paper',y=0.012,text=f"{second_val}",font=dict(size=12))
-    fig.add_annotation(showarrow=False,xref='paper', x=0, yref='paper',y=0.05,text=f"{first_val}",font=dict(size=12))
-    fig.add_annotation(showarrow=False,xref='paper', x=0.03, yref='paper',y=0.1,text="Change from Baseline",font=dict(size=14))
-    fig.add_annotation(showarrow=False,xref='paper', x=-0.06, yref='paper',y=0.65,textangle=-90,text="Analysis value",font=dict(size=18))
-    fig.add_annotation(showarrow=False,xref='paper', x=0.535, yref='paper',y= 0.17,text="Study day relative to treatment start day",font=dict(size=18))
-    fig.add_annotation(showarrow=False,xref='paper', x=0.535, yref='paper',y= 1.05,text=f'Usubjid: {subjid}, Treatment: {filtered_raw["trta"].unique()[0]}',font=dict(size=18))
-
-
-    return fig
-
-@callback(Output("seriesplot", "figure"),
+        rows = filtered_raw[filtered_raw["paramcd"] == paramcd]
+        traces.append({"line": {"dash": LINE_TYPES[i]}, "marker": {"color": LINE_COLORS[i]}, "name": paramcd,
+                       "x": rows["ady"].astype(str).tolist(), "y": figures.array(rows["aval"]), "type": "scatter"})
+    traces.append({"cells": {"fill": CLEAR, "values": [figures.array(table_data[param].round(3)) for param in table_data.columns]},
+                   "domain": {"y": [0, 0.1]}, "header": {"fill": CLEAR, "values": []}, "type": "table"})
+
+    labels = [
+        {"font": {"size": 8}, "showarrow": False, "text": f"{first_val} ULN", "x": 1, "xref": "paper", "y": alt_min + 0.21},
+        {"font": {"size": 8}, "showarrow": False, "text": f"{second_val} ULN", "x": 1, "xref": "paper", "y": ast_min + 0.21},
+        {"font": {"size": 12}, "showarrow": False, "text": f"{second_val}", "x": 0, "xref": "paper", "y": 0.012, "yref": "paper"},
+        {"font": {"size": 12}, "showarrow": False, "text": f"{first_val}", "x": 0, "xref": "paper", "y": 0.05, "yref": "paper"},
+    ]
+    subject = {"font": {"size": 18}, "showarrow": False, "text": f'Usubjid: {subjid}, Treatment: {filtered_raw["trta"].unique()[0]}',
+               "x": 0.535, "xref": "paper", "y": 1.05, "yref": "paper"}
+
+    # Ticks of the last parameter drawn
+    return {"data": traces, "layout": {
+        "template": figures.template("simple_white"),
+        "shapes": [_uln_line(alt_min), _uln_line(ast_min)],
+        "legend": LEGEND,
+        "title": {"font": TITLE_FONT, "text": f"<b>{first_val} and {second_val} Results Over Time. (Safety Analysis Set)</b>", "x": 0.535},
+        "height": 800,
+        "yaxis": {"domain": [0.25, 1]},
+        "xaxis": {"tickmode": "array", "tickvals": [str(val) for val in rows["ady"].unique()]},
+        "annotations": labels + FOOTNOTES + [subject],
+    }}
+
+@callback([Output("seriesplot", "figure"), Output("seriesplot-shown", "data")],
               [Input("usubjid", "value"),
                Input("first_paramcd", "value"),
-               Input("second_paramcd", "value")])
-def update_series_plot(subjid, first_val, second_val):
-    return create_series_plot(subjid, first_val, second_val)
-
+               Input("second_paramcd", "value"),
+               Input("study", "value")],
+              State("seriesplot-shown", "data"))
+@instrument
+def update_series_plot(subjid, first_val, second_val, study, shown):
+    return figure_cache.render_patch("seriesplot", create_series_plot, shown, subjid, first_val, second_val, study=study)
+
+
+@callback([Output("siteid", "options"), Output("siteid", "value"), Output("arm", "options"), Output("arm", "value"),
+               Output("usubjid", "value")],
+              Input("study", "value"),
+              [State("siteid", "value"), State("arm", "value"), State("usubjid", "value")])
+def update_subject_filters(study, site, arm, subjid):
+    store = get_store(study)
+    index = store.subject_index
+    # Selections made in another study fall back to no filter and the first subject
+    if site not in {option['value'] for option in index.site_options}:
+        site = None
+    if arm not in {option['value'] for option in index.arm_options}:
+        arm = None
+    if subjid not in store.subjects:
+        subjid = store.subjects[0]
+    return index.site_options, site, index.arm_options, arm, subjid
+
+
+@callback(Output("usubjid", "options"),
+              [Input("usubjid", "search_value"),
+               Input("siteid", "value"),
+               Input("arm", "value"),
+               Input("study", "value"),
+               Input("usubjid", "value")])
+@instrument
+def search_subjects(search_value, site, arm, study, subjid):
+    matches = get_store(study).subject_index.search(search_value, site, arm, limit=SUBJECT_SEARCH_LIMIT)
+    # Keep the selected subject in the options, the dropdown shows only values it has an option for
+    if subjid and subjid not in matches:
+        matches = [subjid] + matches
+    return [{'label': value, 'value': value} for value in matches]
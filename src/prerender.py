@@ -0,0 +1,148 @@
+'''
+ Pre-render every figure of the four pages.
+
+ Every input combination (each parameter for the box and waterfall plots,
+ ordered parameter pairs for the scatter plot, subject x pair for the series
+ plot) of every study is rendered across a process pool and written to a
+ content-addressed export directory, see core/artifacts.py. Start the app with
+ PRERENDER_DIR pointing at it to serve these figures. Figures whose data did
+ not change since the last export are skipped; inputs without data are
+ skipped too, any other failure is logged and makes the command exit with 1.
+ Run from src/:
+
+   python -m prerender --out prerendered
+   python -m prerender --out prerendered --pages boxplot waterfall --images png
+'''
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from core import artifacts, data, figures
+
+
+logger = logging.getLogger(__name__)
+
+PAGES = ["boxplot", "waterfall", "scatterplot", "seriesplot"]
+
+# Set before the pool forks, read by the render processes
+_create = {}
+_out_dir = None
+_image_format = None
+
+
+def _creators():
+    import app  # registers the pages
+    from pages import boxplot, scatterplot, seriesplot, waterfall
+
+    return {
+        "boxplot": boxplot.create_box_plot,
+        "waterfall": waterfall.create_waterfall_plot,
+        "scatterplot": scatterplot.create_scatter_plot,
+        "seriesplot": seriesplot.create_series_plot,
+    }
+
+
+def page_inputs(page, store, max_subjects=None):
+    '''Every input combination of page on the data of store.'''
+    if page in ("boxplot", "waterfall"):
+        return [(param,) for param in store.params]
+    pairs = [(first, second) for first in store.params for second in store.params if first != second]
+    if page == "scatterplot":
+        return pairs
+    return [(subject,) + pair for subject in store.subjects[:max_subjects] for pair in pairs]
+
+
+def without_data(page, store, inputs):
+    '''Whether the store has no rows to plot for these inputs, so the page cannot render them.'''
+    if page == "boxplot":
+        return store.count(inputs[0], "visit") == 0
+    if page in ("waterfall", "scatterplot"):
+        return any(store.count(param, "post_baseline") == 0 for param in inputs)
+    subject, *params = inputs
+    return any(store.subject_series(param, subject).empty for param in params)
+
+
+def _render(task):
+    page, study, inputs = task
+    with data.pinned_store(study) as store:
+        try:
+            payload = figures.to_json(_create[page](*inputs))
+        except Exception as exc:
+            return task, None, f"{type(exc).__name__}: {exc}", without_data(page, store, inputs)
+        version = store.version_of(*inputs)
+    digest = artifacts.write_figure(_out_dir, payload)
+    if _image_format:
+        import plotly.io as pio
+
+        image = os.path.join(_out_dir, "images", f"{digest}.{_image_format}")
+        if not os.path.exists(image):
+            pio.write_image(json.loads(payload), image, format=_image_format)
+    return task, {"file": digest, "version": version}, None, False
+
+
+def main():
+    global _create, _out_dir, _image_format
+
+    parser = argparse.ArgumentParser(description="Pre-render the figures of the dashboard pages")
+    parser.add_argument("--out", required=True, help="export directory, created if missing")
+    parser.add_argument("--study", nargs="+", help="studies to export (default every study in DATA_DIR)")
+    parser.add_argument("--pages", nargs="+", choices=PAGES, default=PAGES)
+    parser.add_argument("--subjects", type=int, help="export the series plot of the first N subjects only")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--images", choices=["png", "svg", "pdf"], help="also write static images (needs kaleido)")
+    parser.add_argument("--force", action="store_true", help="re-render figures that are already current")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+
+    if args.images:
+        try:
+            import kaleido  # noqa: F401
+        except ImportError:
+            parser.error("--images needs the kaleido package")
+
+    _create, _out_dir, _image_format = _creators(), args.out, args.images
+    os.makedirs(os.path.join(args.out, "figures"), exist_ok=True)
+    if args.images:
+        os.makedirs(os.path.join(args.out, "images"), exist_ok=True)
+    entries = {} if args.force else artifacts.read_manifest(args.out)
+
+    errors = 0
+    for study in args.study or list(data.catalog()):
+        start = time.perf_counter()
+        store = data.get_store(study)
+        tasks = []
+        for page in args.pages:
+            for inputs in page_inputs(page, store, args.subjects):
+                entry = entries.get(artifacts.entry_key(page, study, inputs))
+                if entry is None or entry["version"] != store.version_of(*inputs):
+                    tasks.append((page, study, inputs))
+
+        # Forked after the study is loaded, so the render processes share it
+        empty = failed = 0
+        with ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context("fork")) as pool:
+            for (page, _, inputs), entry, error, no_data in pool.map(_render, tasks, chunksize=16):
+                if entry is not None:
+                    entries[artifacts.entry_key(page, study, inputs)] = entry
+                elif no_data:
+                    empty += 1
+                    logger.debug("Skipped %s%r without data: %s", page, inputs, error)
+                else:
+                    failed += 1
+                    logger.warning("Failed to render %s%r of study %s: %s", page, inputs, study, error)
+        artifacts.write_manifest(args.out, entries)
+        logger.info("Study %s: rendered %d figures (%d without data, %d failed) in %.1fs", study,
+                    len(tasks) - empty - failed, empty, failed, time.perf_counter() - start)
+        errors += failed
+
+    if errors:
+        logger.error("%d figures failed to render", errors)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app imports its modules relative to src/, as when run with --chdir src
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,173 @@
+'''
+ The graph_objects figure builders of the pages before they assembled plain
+ dicts, kept as the reference for test_figures.py. Each takes the data its
+ page computes for the inputs.
+'''
+import plotly.express as px
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+from pages import boxplot, scatterplot
+
+
+def summary_box_plot(stats, outliers):
+    fig = go.Figure()
+    # Arms coloured and ordered like px.box does for the point mode
+    for i, trt in enumerate(boxplot.summary_box_arms(stats)):
+        arm = stats[stats["trta"] == trt]
+        points = outliers[outliers["trta"] == trt].groupby("avisitn")["aval"].apply(list)
+        fig.add_trace(go.Box(
+            name=trt, x=arm["avisitn"].astype(str), orientation="v",
+            q1=arm["q1"], median=arm["median"], q3=arm["q3"], mean=arm["mean"],
+            lowerfence=arm["lowerfence"], upperfence=arm["upperfence"],
+            y=[points.get(visit, []) for visit in arm["avisitn"]], boxpoints="outliers",
+            legendgroup=trt, offsetgroup=trt, alignmentgroup="True", marker_color=boxplot.COLORWAY[i % len(boxplot.COLORWAY)]
+        ))
+    fig.update_layout(boxmode="group")
+    return fig
+
+
+def box_plot(trt_selection, adlbc_plot):
+    if isinstance(adlbc_plot, tuple):
+        fig = summary_box_plot(*adlbc_plot)
+    else:
+        fig = px.box(adlbc_plot, x = "avisitn", y = "aval", color = "trta")
+
+    fig.update_layout(xaxis_title = "Visit", yaxis_title = f"Analysis value: {trt_selection.title()}", template = "simple_white",
+                      legend = dict(orientation = "h",
+                                    title = "", x = 0.3, y = -0.1,
+                                    font = dict(size = 12, color = "black"), bordercolor = "black", borderwidth = 1),
+                      title_text="<b>Test Results for {} in Each Visit<b>".format(trt_selection.title()), title_x=0.5, title_font=dict(size=24, family="Balto"))
+
+    fig.update_traces(hovertemplate= f'<b>{trt_selection}/b>: %{{y}}<br>' +
+                                     '<b>Visit Number</b>: %{x}')
+    return fig
+
+
+def waterfall_plot(trt_selection, arms):
+    treatments = [trt for trt, _ in arms]
+
+    master_fig = make_subplots(rows=len(treatments), cols=1, subplot_titles=treatments, vertical_spacing=0.065)
+    for i, (trt, sorted_data) in enumerate(arms):
+        list_x = list(sorted_data['xValues_sorted'][sorted_data["MaxPchg"] == 100])
+
+        trace = go.Bar(x=sorted_data['xValues_sorted'], y=sorted_data['MaxPchg'], text=["U" for x in list_x],
+                    textposition='outside', insidetextanchor='start',
+                    hovertemplate='<b>Subject</b>: %{customdata}<br>' +
+                                    '<b>X Value</b>: %{x}<br>' +
+                                    '<b>Change</b>: %{y}' +
+                                    '<extra></extra>',
+                    customdata=sorted_data["usubjid"])
+
+        rect_shape = go.layout.Shape(
+            type='rect', xref='x', yref='y',
+            x0=0, y0=sorted_data['MaxPchg'].min() - 10, x1=len(sorted_data) + 1, y1=sorted_data['MaxPchg'].max() + 12,
+            line={'width': 1, 'color': 'black'}
+        )
+
+        master_fig.add_trace(trace, row=i + 1, col=1)
+        master_fig.add_shape(rect_shape, row=i + 1, col=1)
+        master_fig.update_yaxes(range=[sorted_data['MaxPchg'].min() - 10, sorted_data['MaxPchg'].max() + 12], row=i + 1, col=1)
+
+    for i, trt in enumerate(treatments):
+        master_fig['layout']['annotations'][i].update(text=f'{trt}')
+
+    master_fig.update_layout(height=1300, title_text=f"<b>Waterfall Plot of Maximum Post Baseline Percentage Change in {trt_selection}</b>",title_x=0.5,showlegend=False,
+                            plot_bgcolor='white', margin=dict(b=100), title_font=dict(size=24, family="Balto")
+    )
+
+    master_fig.add_annotation(showarrow=False,xref='paper', x=-0.05, yref='paper',y=0.5,textangle=-90,text="Maximum post baseline percentage change",font=dict(size=14.5))
+    master_fig.add_annotation(text="Each bar represents unique subject's maximum percentage change.", x=0, y=-0.05, showarrow=False, xref="paper", yref="paper",font=dict(size=12))
+    master_fig.add_annotation(text="If subject's maximum percentage change was greater than 100 percent then the change was displayed as 100 and indicated with the letter U in plot.",
+                            x=0, y=-0.07, showarrow=False, xref="paper", yref="paper",font=dict(size=12))
+    return master_fig
+
+
+def scatter_plot(first_val, second_val, data):
+    transposed, (RefLineH1, RefLineH2), (RefLineL1, RefLineL2) = data
+    n_levels = transposed.index.get_level_values('N_trt')
+
+    fig = px.scatter(transposed, x=second_val, y=first_val, facet_col=n_levels, color=n_levels,
+                 facet_col_spacing = 0.001, render_mode="webgl" if len(transposed) > scatterplot.SCATTER_GL_POINTS else "svg")
+
+    fig.add_hline(y=RefLineH2,line_width=2, line_dash="dash", line_color="gray")
+    fig.add_hline(y=RefLineL2,line_width=2, line_dash="dash", line_color="gray")
+    fig.add_vline(x=RefLineH1,line_width=2, line_dash="dash", line_color="gray")
+    fig.add_vline(x=RefLineL1,line_width=2, line_dash="dash", line_color="gray")
+
+    for i,anno in enumerate(fig['layout']['annotations']):
+        anno['text']=[f"{col_name}" for col_name in n_levels.unique()][i]
+
+    fig.update_traces(mode="markers",
+                    hovertemplate= '<b>Subject</b>: %{customdata}<br>' +
+                                    f'<b>{second_val}</b>: %{{x}}<br>' +
+                                    f'<b>{first_val}</b>: %{{y}}'+
+                                    '<extra></extra>',
+                    customdata=transposed.index.get_level_values('usubjid').unique())
+
+    fig.update_xaxes(title_text='',ticks='inside',linecolor='black',type="log",mirror=True)
+    fig.update_yaxes(title_text='',ticks='inside',linecolor='black',type="log",mirror=True)
+
+    fig.add_annotation(showarrow=False,xref='paper', x=0.5, yref='paper',y=-0.06,text=f'Maximum post baseline {second_val}', font=dict(size=14))
+    fig.add_annotation(showarrow=False,xref='paper', x=-0.06, yref='paper',y=0.5,textangle=-90,text=f'Maximum post baseline {first_val}',font=dict(size=14))
+    fig.add_annotation(showarrow=False,xref='paper', x=0, yref='paper',y=-0.07,text='Each data point represents a unique subject.')
+    fig.add_annotation(showarrow=False,xref='paper', x=0, yref='paper',y=-0.09,text='Logarithmic scaling was used on both X and Y axis.')
+
+    fig.update_layout(plot_bgcolor='white',showlegend=False, title_text=f'<b>Scatter Plot of {first_val} vs {second_val} (Safety Analysis Set)</b>', title_x=0.5, title_font=dict(size=24, family="Balto"))
+    return fig
+
+
+def series_plot(subjid, first_val, second_val, data):
+    filtered_raw, table_data, alt_min, ast_min = data
+    colors = ["purple", "darkgreen"]
+    line_types = ["dash", "longdash"]
+
+    fig = go.Figure()
+    for i, paramcd in enumerate(filtered_raw["paramcd"].unique()):
+        fig.add_trace(go.Scatter(
+            x=filtered_raw["ady"][filtered_raw["paramcd"] == paramcd].astype({"ady":"str"}),
+            y=filtered_raw["aval"][filtered_raw["paramcd"] == paramcd],
+            marker=dict(color=colors[i]),
+            line=dict(dash = line_types[i]),
+            name=paramcd
+        ))
+
+    fig.add_hline(y=alt_min,line_width=1, line_dash="solid", line_color="gray", opacity=0.7)
+    fig.add_hline(y=ast_min,line_width=1, line_dash="solid", line_color="gray", opacity=0.7)
+
+    fig.update_layout(height =800, template = "simple_white",
+                        legend = dict(orientation = "h",
+                                    title = "", x = 0.5, y = 0.155,
+                                    font = dict(size = 12, color = "black"), bordercolor = "black", borderwidth = 1),
+                        title_text=f"<b>{first_val} and {second_val} Results Over Time. (Safety Analysis Set)</b>", title_x=0.535,
+                        title_font=dict(size=24, family="Balto"))
+
+    fig.add_trace(go.Table(
+        header=dict(values=[], fill=dict(color='rgba(0, 0, 0, 0)')),
+        cells=dict(
+            values=[table_data[param].round(3) for param in table_data.columns],
+            fill=dict(color='rgba(0, 0, 0, 0)')
+        ),
+        domain=dict(y=[0, 0.1])
+    ))
+
+    fig.update_layout(
+        yaxis=dict(domain=[0.25, 1])
+    )
+
+    fig.update_layout(
+        xaxis=dict(
+            tickmode='array',
+            tickvals=[str(val) for val in filtered_raw["ady"][filtered_raw["paramcd"] == paramcd].unique()]
+        )
+    )
+
+    fig.add_annotation(x=1, y=alt_min + 0.21,text=f'{first_val} ULN',showarrow=False,font=dict(size=8),xref="paper")
+    fig.add_annotation(x=1,y=ast_min + 0.21, text=f'{second_val} ULN', showarrow=False, font=dict(size=8), xref="paper")
+    fig.add_annotation(showarrow=False,xref='paper', x=0, yref='paper',y=0.012,text=f"{second_val}",font=dict(size=12))
+    fig.add_annotation(showarrow=False,xref='paper', x=0, yref='paper',y=0.05,text=f"{first_val}",font=dict(size=12))
+    fig.add_annotation(showarrow=False,xref='paper', x=0.03, yref='paper',y=0.1,text="Change from Baseline",font=dict(size=14))
+    fig.add_annotation(showarrow=False,xref='paper', x=-0.06, yref='paper',y=0.65,textangle=-90,text="Analysis value",font=dict(size=18))
+    fig.add_annotation(showarrow=False,xref='paper', x=0.535, yref='paper',y= 0.17,text="Study day relative to treatment start day",font=dict(size=18))
+    fig.add_annotation(showarrow=False,xref='paper', x=0.535, yref='paper',y= 1.05,text=f'Usubjid: {subjid}, Treatment: {filtered_raw["trta"].unique()[0]}',font=dict(size=18))
+    return fig
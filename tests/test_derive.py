@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from core.derive import max_percent_change
+
+# The reference pipeline applies over the grouping columns, which pandas deprecated
+pytestmark = pytest.mark.filterwarnings("ignore:DataFrameGroupBy.apply:DeprecationWarning")
+
+
+def calculate_pchg(group):
+    group['pchg'] = 100 * (group['aval'] - group['base']) / group['base']
+    group['MaxPchg'] = group['pchg'].max()
+    return group
+
+
+def reference_max_percent_change(rows):
+    # The waterfall page's pipeline before max_percent_change()
+    grouped_data = rows.groupby(['trta', 'usubjid']).apply(calculate_pchg)
+    grouped_data = grouped_data.reset_index(drop=True).groupby("usubjid").head(1).dropna(subset=['pchg'])
+    grouped_data = grouped_data.reset_index()[["trta", "usubjid", "MaxPchg"]]
+    grouped_data['MaxPchg'] = np.where(grouped_data['MaxPchg'] > 100, 100, grouped_data['MaxPchg'])
+    arms = []
+    for trt in grouped_data["trta"].unique():
+        sorted_data = grouped_data[grouped_data["trta"] == trt].sort_values(by='MaxPchg', ascending=False)
+        sorted_data['xValues_sorted'] = range(1, len(sorted_data) + 1)
+        arms.append((trt, sorted_data[["usubjid", "MaxPchg", "xValues_sorted"]]))
+    return arms
+
+
+def lab_rows(subjects, seed):
+    rng = np.random.default_rng(seed)
+    arms = np.array(["Placebo", "Xanomeline High Dose", "Xanomeline Low Dose"])
+    subject_arm = rng.choice(arms, subjects)
+    visits = rng.integers(1, 6, subjects)
+    usubjid = np.repeat([f"01-{i:04d}" for i in range(subjects)], visits)
+    base = np.round(rng.uniform(5, 50, len(usubjid)), 1)
+    rows = pd.DataFrame({
+        "usubjid": usubjid,
+        "trta": np.repeat(subject_arm, visits),
+        "aval": np.round(base * rng.uniform(0.3, 3, len(usubjid)), 1),
+        "base": base,
+    })
+    return rows.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def assert_same(rows):
+    expected = reference_max_percent_change(rows)
+    # The store holds the string columns as categoricals
+    for lab in [rows, rows.astype({"usubjid": "category", "trta": "category"})]:
+        result = max_percent_change(lab)
+        assert [trt for trt, _ in result] == [trt for trt, _ in expected]
+        for (_, frame), (_, reference) in zip(result, expected):
+            pd.testing.assert_frame_equal(frame.reset_index(drop=True).astype({"usubjid": str}),
+                                          reference.reset_index(drop=True), check_dtype=False)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_reference(seed):
+    assert_same(lab_rows(200, seed))
+
+
+def test_zero_and_missing_base():
+    rows = lab_rows(60, 7)
+    rows.loc[rows.index[::7], "base"] = 0
+    rows.loc[rows.index[3::11], "base"] = np.nan
+    rows.loc[rows.index[5::13], "aval"] = np.nan
+    assert_same(rows)
+
+
+def test_subject_in_two_arms():
+    rows = lab_rows(30, 3)
+    subject = rows["usubjid"].iloc[0]
+    other_arm = next(arm for arm in rows["trta"].unique() if arm != rows["trta"].iloc[0])
+    moved = pd.DataFrame({"usubjid": [subject, subject], "trta": [other_arm] * 2, "aval": [30.0, 80.0], "base": [20.0, 20.0]})
+    assert_same(pd.concat([rows, moved], ignore_index=True))
+
+
+def test_no_rows():
+    assert max_percent_change(lab_rows(5, 0).iloc[:0]) == []
@@ -0,0 +1,96 @@
+import json
+
+import plotly.io as pio
+import pytest
+
+from core import data, figures
+
+pytestmark = pytest.mark.filterwarnings("ignore::FutureWarning")
+
+
+@pytest.fixture(scope="module")
+def pages():
+    import app  # registers the pages
+    from pages import boxplot, scatterplot, seriesplot, waterfall
+
+    import reference_figures
+
+    return boxplot, scatterplot, seriesplot, waterfall, reference_figures
+
+
+@pytest.fixture(scope="module")
+def study_dir(tmp_path_factory):
+    from bench import synthetic
+
+    folder = str(tmp_path_factory.mktemp("study"))
+    synthetic.write(folder, 5000, seed=1)
+    return folder
+
+
+@pytest.fixture(scope="module", params=["memory", "partitioned"])
+def store(request, study_dir):
+    chunksize = data.INGEST_CHUNKSIZE
+    data.INGEST_CHUNKSIZE = 1000 if request.param == "partitioned" else 0
+    try:
+        store = data.load_store(study_dir, "synthetic")
+    finally:
+        data.INGEST_CHUNKSIZE = chunksize
+    # Pinned, so the pages read the synthetic study whatever DATA_DIR holds
+    token = data._pinned.set(store)
+    yield store
+    data._pinned.reset(token)
+
+
+def assert_same(reference, figure):
+    # Structural equality of what the browser receives
+    assert json.loads(figures.to_json(figure)) == json.loads(pio.to_json(reference))
+
+
+def pairs(store):
+    params = store.params
+    return [(first, second) for first in params[:6] for second in params[:6] if first != second]
+
+
+def test_box_plot(pages, store):
+    boxplot, *_, reference = pages
+    for param in store.params:
+        rows = boxplot.box_plot_data(param)
+        assert_same(reference.box_plot(param, rows), boxplot.create_box_plot(param, rows))
+        stats = store.box_stats(param)
+        assert_same(reference.box_plot(param, stats), boxplot.create_box_plot(param, stats))
+
+
+def test_waterfall_plot(pages, store):
+    *_, waterfall, reference = pages
+    for param in store.params:
+        arms = waterfall.waterfall_plot_data(param)
+        assert_same(reference.waterfall_plot(param, arms), waterfall.create_waterfall_plot(param, arms))
+
+
+@pytest.mark.parametrize("gl_points", [1000, 0])
+def test_scatter_plot(pages, store, monkeypatch, gl_points):
+    _, scatterplot, *_, reference = pages
+    monkeypatch.setattr(scatterplot, "SCATTER_GL_POINTS", gl_points)
+    for first, second in pairs(store):
+        points = scatterplot.scatter_plot_data(first, second)
+        assert_same(reference.scatter_plot(first, second, points), scatterplot.create_scatter_plot(first, second, points))
+
+
+def test_series_plot(pages, store):
+    _, _, seriesplot, _, reference = pages
+    for subject in store.subjects[:5]:
+        for first, second in pairs(store):
+            series = seriesplot.series_plot_data(subject, first, second)
+            if series[0].empty:
+                # Not in the safety set, the old figure code fails without rows
+                continue
+            assert_same(reference.series_plot(subject, first, second, series),
+                        seriesplot.create_series_plot(subject, first, second, series))
+
+
+def test_box_plot_modes_share_arm_colours(pages, store):
+    boxplot, *_ = pages
+    for param in store.params:
+        points = boxplot.create_box_plot(param, boxplot.box_plot_data(param))["data"]
+        summary = boxplot.create_box_plot(param, store.box_stats(param))["data"]
+        assert [(trace["name"], trace["marker"]) for trace in summary] == [(trace["name"], trace["marker"]) for trace in points]